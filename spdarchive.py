@@ -0,0 +1,260 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+import struct
+import hashlib
+from pathlib import Path
+from collections import Counter
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import writespdfile, printerr, SPD_DDR5_EEPROM_SIZE, SPD_ARCHIVE_FILE_EXT
+
+# Archive layout: header, base images (one per kit family), deltas
+# of all members against their base, then the index of members.
+#   header: magic, version, number of bases, of members, index offset
+#   index entry: base, delta offset, delta length, SHA-256, name length
+#   (followed by the name itself, UTF-8)
+#   delta: runs of (offset, length) followed by that many bytes
+SPD_ARCHIVE_MAGIC = b'SPDA'
+SPD_ARCHIVE_VERSION = 1
+SPD_ARCHIVE_HEADER = struct.Struct('<4sB3xIII')
+SPD_ARCHIVE_ENTRY = struct.Struct('<IIH32sH')
+SPD_ARCHIVE_RUN = struct.Struct('<HB')
+SPD_ARCHIVE_RUN_MAX = 0xff
+SPD_ARCHIVE_CHUNK = 64 # bytes compared at once when looking for differences
+
+def usage():
+    printerr(sys.argv[0], '--archive <file> --create <dir> | --list | --extract <member>[,...] | --unpack | --verify --out <dir> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'a:h', ['archive=', 'create=', 'list', 'extract=', 'unpack', 'verify', 'out=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    archive = ''
+    op = ''
+    create = ''
+    members = []
+    out = '.'
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print(sys.argv[0], '--archive <file> --create <dir> | --list | --extract <member>[,...] | --unpack | --verify --out <dir>')
+            print('  -a --archive: dump archive (`.{}`)'.format(SPD_ARCHIVE_FILE_EXT))
+            print('  --create: pack all `.spd` files in the directory tree into a new archive.')
+            print('    (One base image is kept per manufacturer and part number,')
+            print('    every dump is stored as the bytes differing from it.)')
+            print('  --list: list members, their base image and delta size.')
+            print('  --extract: save the member(s) to the output directory.')
+            print('  --unpack: save all members to the output directory.')
+            print('  --verify: check every member against its SHA-256 hash.')
+            print('  --out: output directory for --extract and --unpack (.)')
+            print('')
+            print('Other tools read members directly as `<archive>.{}#<member>`.'.format(SPD_ARCHIVE_FILE_EXT))
+            sys.exit(0)
+        elif opt in ('-a', '--archive'):
+            archive = arg
+        elif opt in ('--create'):
+            op = 'create'
+            create = arg
+        elif opt in ('--list'):
+            op = 'list'
+        elif opt in ('--extract'):
+            op = 'extract'
+            members = arg.split(',')
+        elif opt in ('--unpack'):
+            op = 'unpack'
+        elif opt in ('--verify'):
+            op = 'verify'
+        elif opt in ('--out'):
+            out = arg
+    if archive == '' or op == '':
+        usage()
+
+    if op == 'create':
+        createarchive(create, archive)
+        return
+    with SpdArchive(archive) as spda:
+        if op == 'list':
+            listarchive(spda)
+        elif op == 'verify':
+            verifyarchive(spda)
+        else:
+            extractarchive(spda, spda.members() if op == 'unpack' else members, out)
+
+def deltaencode(base, data):
+    delta = bytearray()
+    idx = 0
+    while idx < SPD_DDR5_EEPROM_SIZE:
+        if idx % SPD_ARCHIVE_CHUNK == 0 \
+        and data[idx:idx + SPD_ARCHIVE_CHUNK] == base[idx:idx + SPD_ARCHIVE_CHUNK]:
+            idx += SPD_ARCHIVE_CHUNK
+            continue
+        if data[idx] == base[idx]:
+            idx += 1
+            continue
+        # A run goes on over equal bytes as long as
+        # that is cheaper than starting a new one
+        end = idx + 1
+        last = idx
+        while end < SPD_DDR5_EEPROM_SIZE and end - idx < SPD_ARCHIVE_RUN_MAX \
+        and end - last <= SPD_ARCHIVE_RUN.size:
+            if data[end] != base[end]:
+                last = end
+            end += 1
+        delta += SPD_ARCHIVE_RUN.pack(idx, last + 1 - idx) + data[idx:last + 1]
+        idx = last + 1
+    return bytes(delta)
+
+def deltaapply(base, delta):
+    data = bytearray(base)
+    pos = 0
+    while pos < len(delta):
+        off, length = SPD_ARCHIVE_RUN.unpack_from(delta, pos)
+        pos += SPD_ARCHIVE_RUN.size
+        data[off:off + length] = delta[pos:pos + length]
+        pos += length
+    return bytes(data)
+
+def familybase(images):
+    # The most common value of every byte across the family,
+    # not necessarily any of the actual images
+    return bytes(Counter(column).most_common(1)[0][0] for column in zip(*images))
+
+def createarchive(dirpath, filepath):
+    from spdinfo import corpusfiles, decodeidentity
+    if not Path(dirpath).is_dir():
+        printerr('Directory not found: "{}".'.format(dirpath))
+        sys.exit(1)
+    families = {}
+    ignored = 0
+    for path in corpusfiles(dirpath):
+        try:
+            data = Path(path).read_bytes()
+        except OSError:
+            ignored += 1
+            continue
+        if len(data) != SPD_DDR5_EEPROM_SIZE:
+            ignored += 1
+            continue
+        identity = decodeidentity(data)
+        name = Path(path).relative_to(dirpath).as_posix()
+        families.setdefault((identity['manufacturer'], identity['partnumber']), []).append((name, data))
+    if len(families) == 0:
+        printerr('No dumps found in "{}".'.format(dirpath))
+        sys.exit(1)
+
+    bases = bytearray()
+    deltas = bytearray()
+    index = bytearray()
+    count = 0
+    offset = SPD_ARCHIVE_HEADER.size + len(families) * SPD_DDR5_EEPROM_SIZE
+    for basenum, key in enumerate(sorted(families)):
+        base = familybase([data for name, data in families[key]])
+        bases += base
+        for name, data in families[key]:
+            delta = deltaencode(base, data)
+            encoded = name.encode()
+            index += SPD_ARCHIVE_ENTRY.pack(basenum, offset + len(deltas), len(delta)
+            , hashlib.sha256(data).digest(), len(encoded)) + encoded
+            deltas += delta
+            count += 1
+    header = SPD_ARCHIVE_HEADER.pack(SPD_ARCHIVE_MAGIC, SPD_ARCHIVE_VERSION, len(families), count
+    , offset + len(deltas))
+    archive = header + bases + deltas + index
+    writespdfile(filepath, archive)
+    print('{} dump(s) from {} kit famil{} packed into "{}": {} bytes ({:.1%} of {}), {} ignored.'.format(count
+    , len(families), 'y' if len(families) == 1 else 'ies', filepath, len(archive)
+    , len(archive) / (count * SPD_DDR5_EEPROM_SIZE), count * SPD_DDR5_EEPROM_SIZE, ignored))
+
+class SpdArchive:
+    # Read access to a single archive: only the header and
+    # the index are read on opening, members are read on demand
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        self.index = {}
+
+    def __enter__(self):
+        try:
+            self.file = open(self.filepath, 'rb')
+            magic, version, self.bases, count, offset = SPD_ARCHIVE_HEADER.unpack(self.file.read(SPD_ARCHIVE_HEADER.size))
+            if magic != SPD_ARCHIVE_MAGIC or version != SPD_ARCHIVE_VERSION:
+                raise ValueError('not an archive')
+            self.file.seek(offset)
+            data = self.file.read()
+            pos = 0
+            for n in range(0, count):
+                basenum, off, length, digest, namelen = SPD_ARCHIVE_ENTRY.unpack_from(data, pos)
+                pos += SPD_ARCHIVE_ENTRY.size
+                self.index[data[pos:pos + namelen].decode()] = (basenum, off, length, digest)
+                pos += namelen
+        except (OSError, ValueError, struct.error) as e:
+            if self.file is not None:
+                self.file.close()
+            printerr('Could not open archive "{}": {}.'.format(self.filepath, e))
+            sys.exit(1)
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        self.file.close()
+
+    def members(self):
+        return list(self.index)
+
+    def read(self, member):
+        entry = self.index.get(member)
+        if entry is None:
+            printerr('No member "{}" in archive "{}".'.format(member, self.filepath))
+            sys.exit(1)
+        basenum, off, length, digest = entry
+        self.file.seek(SPD_ARCHIVE_HEADER.size + basenum * SPD_DDR5_EEPROM_SIZE)
+        base = self.file.read(SPD_DDR5_EEPROM_SIZE)
+        self.file.seek(off)
+        data = deltaapply(base, self.file.read(length))
+        if hashlib.sha256(data).digest() != digest:
+            printerr('Archive member "{}" is damaged.'.format(member))
+            sys.exit(1)
+        return data
+
+def readmember(filepath, member):
+    with SpdArchive(filepath) as spda:
+        return spda.read(member)
+
+def listarchive(spda):
+    for member, (basenum, off, length, digest) in spda.index.items():
+        print('{}\tbase={}\tdelta={}'.format(member, basenum, length))
+    print('{} member(s), {} base image(s).'.format(len(spda.index), spda.bases))
+
+def verifyarchive(spda):
+    failed = 0
+    for member in spda.members():
+        try:
+            spda.read(member)
+        except SystemExit:
+            failed += 1
+    print('{} member(s) checked, {} damaged.'.format(len(spda.index), failed))
+    if failed != 0:
+        sys.exit(1)
+
+def extractarchive(spda, members, out):
+    for member in members:
+        if Path(member).is_absolute() or '..' in Path(member).parts:
+            printerr('Refusing to extract "{}" outside of the output directory.'.format(member))
+            sys.exit(1)
+        data = spda.read(member)
+        pathfile = Path(out) / member
+        try:
+            pathfile.parent.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            printerr('Could not create directory "{}".'.format(pathfile.parent))
+            sys.exit(1)
+        writespdfile(str(pathfile), data)
+        print('"{}" extracted to "{}".'.format(member, pathfile))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import getopt
+import datetime
+import threading
+from time import monotonic
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, opttraceformat, checkroot, checkddr5, setbackend, settrace, writespdfile \
+, detectspd, SpdDevice, printerr, SPD_DIMM_ADDR_FIRST, SPD_DIMM_ADDR_LAST, SPD_DDR5_EEPROM_SIZE
+from spdread import dumpspd
+from spdwrite import getranges, flashspd, SPD_VERIFY_RETRIES
+from spdinfo import SpdImage, decodeidentity, SPD_SN_OFFSET, SPD_PN_OFFSET, SPD_PN_LENGTH
+
+def usage():
+    printerr(sys.argv[0], '--read | --write <dump> --target <bus>:<dimm>[:<dump>][,...] | --all [--bus <busnum>[,...]] | --manifest <file>'
+    , '--range <0-1023>[,0..1023[,...]] --diff --noverify --block --log <file> --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'b:h', ['read', 'write=', 'target=', 'all', 'bus=', 'manifest='
+        , 'range=', 'diff', 'noverify', 'block', 'log=', 'backend=', 'trace=', 'trace-format=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    op = ''
+    dump = ''
+    tstr = ''
+    detect = False
+    buses = []
+    manifest = ''
+    rstr = ''
+    diff = False
+    verify = True
+    block = False
+    log = ''
+    backend = 'auto'
+    trace = ''
+    tracefmt = 'jsonl'
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--read | --write <dump> --target <bus>:<dimm>[:<dump>][,...] | --all [--bus <busnum>[,...]] | --manifest <file>'
+                , '--range <0-1023>[,0..1023[,...]] --diff --noverify --block --log <file> --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome>')
+                print('  --read: dump every target to "dimm<addr>-bus<busnum>.spd" in the current directory.')
+                print('  --write: flash the SPD dump to every target.')
+                print('  --target: bus number and dimm address pairs (11:0x51,11:0x53)')
+                print('    (With --write, a different dump can be given for each target.)')
+                print('  --all: every SPD hub detected on the SMBus adapter(s).')
+                print('  -b --bus: SMBus adapter(s) to probe with --all (all of them)')
+                print('  --manifest: flash the jobs listed in the file, one JSON object per line:')
+                print('    {"bus": 11, "dimm": "0x51", "image": "new.spd", "range": "0-1023", "partnumber": "UD5-6000", "serial": "0104eef6"}')
+                print('    (`range` and `serial` are optional, image paths are relative to the manifest.')
+                print('    Images, CRCs, ranges and the part and serial numbers found on the modules')
+                print('    are checked for all jobs before anything is written.)')
+                print('  --range: specific region(s) to overwrite (see `spdwrite.py --help`).')
+                print('  --diff: only write bytes that differ from current EEPROM contents.')
+                print('  --noverify: do not read back the pages written to.')
+                print('  --block: read in I2C blocks instead of byte-by-byte.')
+                print('  --log: append the result of every DIMM to this file as JSON Lines.')
+                print('  --backend: SMBus access method (auto)')
+                print('  --trace: record every SMBus transaction to the file.')
+                print('    (A latency summary is printed at the end.)')
+                print('  --trace-format: `jsonl` or `chrome` (chrome://tracing, Perfetto) (jsonl)')
+                print('')
+                print('One worker per SMBus adapter is run in parallel.')
+                print('DIMMs sharing an adapter are always processed one after another.')
+                sys.exit(0)
+            elif opt in ('--read'):
+                op = 'read'
+            elif opt in ('--write'):
+                op = 'write'
+                dump = arg
+            elif opt in ('--target'):
+                tstr = arg
+            elif opt in ('--all'):
+                detect = True
+            elif opt in ('-b', '--bus'):
+                buses = [optint(bus) for bus in arg.split(',')]
+            elif opt in ('--manifest'):
+                manifest = arg
+            elif opt in ('--range'):
+                rstr = arg
+            elif opt in ('--diff'):
+                diff = True
+            elif opt in ('--noverify'):
+                verify = False
+            elif opt in ('--block'):
+                block = True
+            elif opt in ('--log'):
+                log = arg
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
+            elif opt in ('--trace'):
+                trace = arg
+            elif opt in ('--trace-format'):
+                tracefmt = opttraceformat(arg)
+        except:
+            usage()
+    if manifest != '':
+        if op != '' or detect or tstr != '' or rstr != '':
+            usage()
+        op = 'write'
+    elif op == '' or detect == (tstr != ''):
+        usage()
+    ranges = getranges(rstr)
+    if len(ranges) == 0:
+        usage()
+    targets = gettargets(tstr, dump, ranges)
+    if not detect and manifest == '' and len(targets) == 0:
+        usage()
+
+    setbackend(backend)
+    checkroot()
+    checkddr5()
+    if trace != '':
+        settrace(trace, tracefmt)
+    if manifest != '':
+        targets = loadmanifest(manifest, block)
+    elif detect:
+        targets = [[busnum, dimmaddr, dump, ranges] for busnum, dimmaddr in detectspd(buses)]
+    batchspd(op, targets, diff, verify, block, log, manifest != '')
+
+def gettargets(tstr, dump, ranges):
+    # [[busnum, dimmaddr, dump, ranges], ...]
+    if tstr == '':
+        return []
+    targets = []
+    for item in tstr.split(','):
+        fields = item.split(':')
+        if len(fields) < 2 or len(fields) > 3:
+            return []
+        try:
+            busnum = optint(fields[0])
+            dimmaddr = opthex(fields[1])
+        except ValueError:
+            return []
+        if busnum < 0 or busnum > 99 \
+        or dimmaddr < SPD_DIMM_ADDR_FIRST or dimmaddr > SPD_DIMM_ADDR_LAST:
+            return []
+        target = [busnum, dimmaddr, fields[2] if len(fields) > 2 else dump, ranges]
+        if target[:2] in [t[:2] for t in targets]:
+            return []
+        targets.append(target)
+    return targets
+
+def loadmanifest(filepath, block):
+    # Write jobs, one JSON object per line (see `--help`). All of
+    # them are checked up front, and any problem rejects the whole
+    # manifest before a single byte is written.
+    try:
+        with open(filepath, 'r') as file:
+            lines = file.readlines()
+    except OSError:
+        printerr('Could not read manifest "{}".'.format(filepath))
+        sys.exit(1)
+    basedir = Path(filepath).parent
+    targets = []
+    checks = []
+    problems = []
+    for num, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        try:
+            job = json.loads(line)
+            busnum = optint(str(job['bus']))
+            dimmaddr = opthex(str(job['dimm']))
+            dump = str(basedir / job['image'])
+            rstr = job.get('range', '')
+            if not isinstance(rstr, str):
+                raise TypeError('range must be a string')
+            ranges = getranges(rstr)
+            partnumber = str(job['partnumber'])
+            serial = job.get('serial')
+        except (ValueError, KeyError, TypeError) as e:
+            problems.append('line {}: invalid job ({})'.format(num, e))
+            continue
+        if busnum < 0 or busnum > 99 \
+        or dimmaddr < SPD_DIMM_ADDR_FIRST or dimmaddr > SPD_DIMM_ADDR_LAST:
+            problems.append('line {}: invalid bus or DIMM address'.format(num))
+        elif [busnum, dimmaddr] in [target[:2] for target in targets]:
+            problems.append('line {}: bus {} DIMM {} is listed twice'.format(num, busnum, hex(dimmaddr)))
+        elif len(ranges) == 0:
+            problems.append('line {}: invalid range "{}"'.format(num, job['range']))
+        else:
+            targets.append([busnum, dimmaddr, dump, ranges])
+            checks.append((num, partnumber, serial))
+    if len(targets) == 0 and len(problems) == 0:
+        problems.append('no jobs')
+    if len(problems) == 0:
+        print('Checking images and modules of {} job(s) (reading part and serial numbers)...\n'.format(len(targets)))
+        for target, (num, partnumber, serial) in zip(targets, checks):
+            if not manifestimage(target[2]):
+                problems.append('line {}: image "{}" is unusable'.format(num, target[2]))
+            elif not manifestmodule(target[0], target[1], partnumber, serial, block):
+                problems.append('line {}: bus {} DIMM {} is not the expected module'.format(num, target[0], hex(target[1])))
+    if len(problems) != 0:
+        printerr('Manifest "{}" rejected, nothing has been written:'.format(filepath))
+        for problem in problems:
+            printerr('  ' + problem)
+        sys.exit(1)
+    return targets
+
+def manifestimage(dump):
+    try:
+        image = SpdImage.fromfile(dump)
+    except SystemExit:
+        # Already reported
+        return False
+    status = image.crcstatus()
+    if 'fail' in status.values():
+        printerr('"{}" fails CRC check(s): {}.'.format(dump, ', '.join(name for name in status if status[name] == 'fail')))
+        return False
+    return True
+
+def manifestmodule(busnum, dimmaddr, partnumber, serial, block):
+    # Part (and serial) number currently on the module, only reads
+    try:
+        with SpdDevice(busnum, dimmaddr) as dev:
+            data = bytearray(SPD_DDR5_EEPROM_SIZE)
+            data[SPD_SN_OFFSET:SPD_PN_OFFSET + SPD_PN_LENGTH] = dev.read(SPD_SN_OFFSET
+            , SPD_PN_OFFSET + SPD_PN_LENGTH - SPD_SN_OFFSET, block)
+    except SystemExit:
+        return False
+    identity = decodeidentity(data)
+    matches = identity['partnumber'] == partnumber.strip()
+    if serial is not None:
+        serial = str(serial).lower()
+        if serial[:2] == '0x':
+            serial = serial[2:]
+        matches = matches and identity['serial'] == serial
+    if not matches:
+        printerr('Bus {} DIMM {}: found P/N "{}" S/N {}, expected P/N "{}"{}.'.format(busnum, hex(dimmaddr)
+        , identity['partnumber'], identity['serial'], partnumber, ' S/N {}'.format(serial) if serial is not None else ''))
+    return matches
+
+PRINT_LOCK = threading.Lock()
+
+def batchresult(result, log):
+    with PRINT_LOCK:
+        print('Bus {0: >2} DIMM {1}: {2} ({3}, {4:.2f} s)'.format(result['bus'], hex(result['dimm'])
+        , result['status'], result['detail'], result['time']))
+        if log != '':
+            entry = dict(result, dimm=hex(result['dimm']), time=round(result['time'], 3)
+            , date=datetime.datetime.now().isoformat(timespec='seconds'))
+            try:
+                with open(log, 'a') as file:
+                    file.write(json.dumps(entry) + '\n')
+            except OSError:
+                printerr('Could not write to log file "{}".'.format(log))
+
+def batchjob(op, busnum, dimmaddr, image, ranges, diff, verify, block):
+    # Runs a single DIMM job, returns (status, detail, halt the bus)
+    dev = SpdDevice(busnum, dimmaddr)
+    try:
+        with dev:
+            if op == 'read':
+                data = dumpspd(dev, block, False)
+            else:
+                written = flashspd(dev, image, ranges, diff, verify, SPD_VERIFY_RETRIES, False)
+        if op == 'read':
+            filepath = './dimm{}-bus{}.spd'.format(dimmaddr, busnum)
+            writespdfile(filepath, data)
+            return 'OK', 'written to "{}"'.format(filepath), False
+        return 'OK', '{} byte(s) written{}'.format(written, ', verified' if verify and written != 0 else ''), False
+    except SystemExit:
+        # Whatever went wrong has already been reported. Any failure
+        # (not only I/O errors) stops the remaining jobs on the bus.
+        return 'FAILED', 'I/O error' if dev.failed else 'error', True
+
+def batchbus(op, busnum, jobs, images, diff, verify, block, log):
+    # Worker for a single SMBus adapter: DIMMs on the same bus
+    # are processed strictly one after another, so that page
+    # switches of one hub never interleave with another's.
+    results = []
+    halted = False
+    for target in jobs:
+        start = monotonic()
+        result = {'bus': busnum, 'dimm': target[1], 'image': target[2] if op == 'write' else None}
+        if halted:
+            result['status'], result['detail'] = 'SKIPPED', 'bus halted'
+        else:
+            result['status'], result['detail'], halted = batchjob(op, busnum, target[1]
+            , images.get(target[2]), target[3], diff, verify, block)
+        result['time'] = monotonic() - start
+        batchresult(result, log)
+        results.append(result)
+    return results
+
+def batchspd(op, targets, diff, verify, block, log='', checked=False):
+    images = {}
+    if op == 'write':
+        for target in targets:
+            if target[2] not in images:
+                images[target[2]] = SpdImage.fromfile(target[2])
+    else:
+        if not os.access('./', os.W_OK):
+            printerr('Current directory is not writable.')
+            sys.exit(1)
+
+    buses = {}
+    for target in targets:
+        buses.setdefault(target[0], []).append(target)
+
+    print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
+    print('Will now {} {} DIMM(s) on {} SMBus adapter(s):'.format(op, len(targets), len(buses)))
+    for target in targets:
+        print('  /dev/i2c-{}, chip address {}{}'.format(target[0], hex(target[1])
+        , ' <- "{}"'.format(target[2]) if op == 'write' else ''))
+    print('')
+
+    go = input('Continue? (yes/no): ').lower()
+    print('')
+    if go in ['yes']:
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=len(buses)) as pool:
+            futures = [pool.submit(batchbus, op, busnum, jobs, images, diff, verify, block, log)
+            for busnum, jobs in buses.items()]
+            results = []
+            for future in futures:
+                results += future.result()
+        elapsed = monotonic() - start
+        failed = [result for result in results if result['status'] != 'OK']
+        print('')
+        print('{} DIMM(s) processed in {:.2f} s: {} OK, {} failed or skipped.'
+        .format(len(results), elapsed, len(results) - len(failed), len(failed)))
+        if len(failed) != 0:
+            printerr('Some of the DIMMs could not be processed!')
+            sys.exit(1)
+    elif checked:
+        # Modules have been read already to check the manifest
+        print('Exiting without writing to any DIMM.')
+        sys.exit(0)
+    else:
+        print('Exiting without performing any operations on SMBus.')
+        sys.exit(0)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
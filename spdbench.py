@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+import os
+import io
+import sys
+import json
+import getopt
+import datetime
+import subprocess
+from time import monotonic
+from contextlib import redirect_stdout
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, readspdfile, setbus, rswpblocksget, SpdDevice, printerr, SPD_DDR5_EEPROM_SIZE
+from spdbus import SimBus, SimSpd, SPD_SIM_LATENCY, SPD_SIM_WRITE_CYCLE, SPD_SIM_DIMM_ADDR
+from spdread import dumpspd, votespd
+from spdwrite import getranges, flashspd, SPD_VERIFY_RETRIES
+from spdplan import rangestring
+from spdinfo import SpdImage
+
+SPD_BENCH_HISTORY = 'spdbench.jsonl'
+SPD_BENCH_SCENARIOS = ['dump', 'dumpblock', 'dumpvote', 'flash', 'patch', 'rswp']
+SPD_BENCH_PATCH_BYTES = 16
+
+def usage():
+    printerr(sys.argv[0], '--image <dump> --scenario <name>[,...] --latency <us> --write-cycle <us>'
+    , '--nack-rate <p> --bit-errors <p> --seed <n> --history <file> --label <name> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'f:h', ['image=', 'scenario=', 'latency=', 'write-cycle='
+        , 'nack-rate=', 'bit-errors=', 'seed=', 'history=', 'label=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    image = ''
+    scenarios = SPD_BENCH_SCENARIOS
+    params = {
+        'latency': SPD_SIM_LATENCY,
+        'writecycle': SPD_SIM_WRITE_CYCLE,
+        'nackrate': 0.0,
+        'bitrate': 0.0,
+        'seed': 0
+    }
+    history = SPD_BENCH_HISTORY
+    label = None
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--image <dump> --scenario <name>[,...] --latency <us> --write-cycle <us>'
+                , '--nack-rate <p> --bit-errors <p> --seed <n> --history <file> --label <name>')
+                print('  -f --image: SPD dump the simulated hub is loaded with.')
+                print('  --scenario: what to run ({})'.format(','.join(SPD_BENCH_SCENARIOS)))
+                print('    (`patch` rewrites {} damaged bytes given as ranges.)'.format(SPD_BENCH_PATCH_BYTES))
+                print('  --latency: time per SMBus transaction, in microseconds ({})'.format(round(SPD_SIM_LATENCY * 1e6)))
+                print('  --write-cycle: EEPROM write cycle, in microseconds ({})'.format(round(SPD_SIM_WRITE_CYCLE * 1e6)))
+                print('  --nack-rate: probability of a transaction being NACKed (0)')
+                print('  --bit-errors: probability of a bit flip in an EEPROM byte read (0)')
+                print('  --seed: random seed for injected faults (0)')
+                print('  --history: results of every run are appended to this file ({})'.format(SPD_BENCH_HISTORY))
+                print('  --label: name of this run in the history (git revision)')
+                print('')
+                print('No hardware is accessed: the tools run against a simulated SPD5118 hub.')
+                sys.exit(0)
+            elif opt in ('-f', '--image'):
+                image = arg
+            elif opt in ('--scenario'):
+                scenarios = arg.split(',')
+                for name in scenarios:
+                    if name not in SPD_BENCH_SCENARIOS:
+                        raise ValueError('Unknown scenario: "{}"'.format(name))
+            elif opt in ('--latency'):
+                params['latency'] = optint(arg) / 1e6
+            elif opt in ('--write-cycle'):
+                params['writecycle'] = optint(arg) / 1e6
+            elif opt in ('--nack-rate'):
+                params['nackrate'] = float(arg)
+            elif opt in ('--bit-errors'):
+                params['bitrate'] = float(arg)
+            elif opt in ('--seed'):
+                params['seed'] = optint(arg)
+            elif opt in ('--history'):
+                history = arg
+            elif opt in ('--label'):
+                label = arg
+        except:
+            usage()
+    if image == '':
+        usage()
+
+    spddata = readspdfile(image)
+    if label is None:
+        label = revision()
+    results = {}
+    for name in scenarios:
+        results[name] = runscenario(name, spddata, params)
+    previous = historyload(history, params)
+    failed = reportbench(scenarios, results, previous)
+    historysave(history, label, params, results)
+    if failed:
+        sys.exit(1)
+
+def revision():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True
+        , cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except Exception:
+        return 'unknown'
+    return out.stdout.strip() if out.returncode == 0 else 'unknown'
+
+def damaged(spddata):
+    # Image with a few bytes spread over all pages broken
+    data = bytearray(spddata)
+    step = SPD_DDR5_EEPROM_SIZE // SPD_BENCH_PATCH_BYTES
+    idxs = list(range(step // 2, SPD_DDR5_EEPROM_SIZE, step))
+    for idx in idxs:
+        data[idx] ^= 0xff
+    return data, idxs
+
+def runscenario(name, spddata, params):
+    # Runs a single scenario on a fresh simulated bus
+    initial = spddata
+    if name == 'flash':
+        initial = b'\xff' * SPD_DDR5_EEPROM_SIZE
+    elif name == 'patch':
+        initial, idxs = damaged(spddata)
+    hub = SimSpd(initial, params['writecycle'], params['bitrate'], params['seed'])
+    bus = SimBus(0, {SPD_SIM_DIMM_ADDR: hub}, True, params['latency'], nackrate=params['nackrate'], seed=params['seed'])
+    setbus(0, bus)
+
+    image = SpdImage(spddata)
+    status = 'OK'
+    start = monotonic()
+    try:
+        with redirect_stdout(io.StringIO()), SpdDevice(0, SPD_SIM_DIMM_ADDR) as dev:
+            if name == 'dump':
+                data = dumpspd(dev, False, False)
+            elif name == 'dumpblock':
+                data = dumpspd(dev, True, False)
+            elif name == 'dumpvote':
+                data, confidence = votespd(dev, True, verbose=False)
+            elif name == 'flash':
+                flashspd(dev, image, getranges(''), False, True, SPD_VERIFY_RETRIES, False)
+            elif name == 'patch':
+                flashspd(dev, image, getranges(rangestring(idxs)), False, True, SPD_VERIFY_RETRIES, False)
+            elif name == 'rswp':
+                rswpblocksget(dev)
+    except SystemExit:
+        status = 'FAILED'
+    wall = monotonic() - start
+    if status == 'OK':
+        if name in ('dump', 'dumpblock', 'dumpvote') and data != spddata:
+            status = 'CORRUPT'
+        elif name in ('flash', 'patch') and hub.eeprom != spddata:
+            status = 'CORRUPT'
+    return {
+        'status': status,
+        'transactions': bus.transactions,
+        'bytes': bus.bytes,
+        'writes': hub.writes,
+        'wall': round(wall, 4),
+        'rate': round(bus.bytes / wall) if wall != 0 else 0
+    }
+
+def historyload(filepath, params):
+    # Last run in the history with the same simulation parameters
+    previous = None
+    try:
+        with open(filepath, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('params') == params:
+                    previous = entry
+    except OSError:
+        pass
+    return previous
+
+def historysave(filepath, label, params, results):
+    entry = {
+        'label': label,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'params': params,
+        'results': results
+    }
+    try:
+        with open(filepath, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+    except OSError:
+        printerr('Could not write to history file "{}".'.format(filepath))
+        sys.exit(1)
+
+def reportbench(scenarios, results, previous):
+    print('{0: <10} {1: >7} {2: >12} {3: >7} {4: >7} {5: >9} {6: >8}  {7}'.format('Scenario', 'Status'
+    , 'Transactions', 'Bytes', 'Writes', 'Wall (s)', 'B/s'
+    , 'vs {}'.format(previous['label']) if previous is not None else ''))
+    failed = False
+    for name in scenarios:
+        result = results[name]
+        failed = failed or result['status'] != 'OK'
+        change = ''
+        if previous is not None and name in previous['results'] and previous['results'][name]['wall'] != 0:
+            change = '{:+.1f}%'.format((result['wall'] / previous['results'][name]['wall'] - 1) * 100)
+        print('{0: <10} {1: >7} {2: >12} {3: >7} {4: >7} {5: >9.3f} {6: >8}  {7}'.format(name, result['status']
+        , result['transactions'], result['bytes'], result['writes'], result['wall'], result['rate'], change))
+    if failed:
+        printerr('\nWARNING: some scenarios did not complete correctly!')
+    return failed
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
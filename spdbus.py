@@ -0,0 +1,303 @@
+import os
+import errno
+import ctypes
+import random
+import subprocess
+from time import sleep, monotonic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# <linux/i2c-dev.h>
+I2C_SLAVE = 0x0703
+I2C_FUNCS = 0x0705
+I2C_SMBUS = 0x0720
+
+# <linux/i2c.h>
+I2C_SMBUS_READ = 1
+I2C_SMBUS_WRITE = 0
+I2C_SMBUS_BYTE_DATA = 2
+I2C_SMBUS_I2C_BLOCK_DATA = 8
+I2C_SMBUS_BLOCK_MAX = 32
+
+I2C_FUNC_SMBUS_READ_I2C_BLOCK = 0x04000000
+
+# Errors meaning the adapter can't do the transfer at all
+# (as opposed to the transfer having failed on the bus)
+SPD_BUS_UNSUPPORTED = (errno.EOPNOTSUPP, errno.EINVAL)
+
+class I2cSmbusData(ctypes.Union):
+    _fields_ = [('byte', ctypes.c_uint8)
+    , ('word', ctypes.c_uint16)
+    , ('block', ctypes.c_uint8 * (I2C_SMBUS_BLOCK_MAX + 2))]
+
+class I2cSmbusIoctlData(ctypes.Structure):
+    _fields_ = [('read_write', ctypes.c_uint8)
+    , ('command', ctypes.c_uint8)
+    , ('size', ctypes.c_uint32)
+    , ('data', ctypes.POINTER(I2cSmbusData))]
+
+# Every backend provides the same byte-level primitives
+# and I2C block reads of up to 32 bytes. Failures are
+# reported by raising `OSError`: `errno` holds the kernel
+# error code (or `i2ctools` exit status), zero meaning
+# a failure to run the transaction at all.
+
+class I2cDevBus:
+    # Talks to `/dev/i2c-N` directly through `ioctl()`:
+    # the device file is opened once for the whole session.
+    simulated = False
+
+    def __init__(self, busnum):
+        if fcntl is None:
+            raise OSError(errno.ENOSYS, 'ioctl() is not available')
+        self.busnum = busnum
+        self.fd = os.open('/dev/i2c-{}'.format(busnum), os.O_RDWR)
+        self.slave = None
+        self.funcs = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def setslave(self, dimmaddr):
+        if self.slave != dimmaddr:
+            # Same as `i2cget`/`i2cset` without `-f`: refuse
+            # to talk to a chip claimed by a kernel driver.
+            fcntl.ioctl(self.fd, I2C_SLAVE, dimmaddr)
+            self.slave = dimmaddr
+
+    def functionality(self):
+        if self.funcs is None:
+            funcs = ctypes.c_ulong()
+            fcntl.ioctl(self.fd, I2C_FUNCS, funcs)
+            self.funcs = funcs.value
+        return self.funcs
+
+    def smbus(self, dimmaddr, rw, cmd, size, data):
+        self.setslave(dimmaddr)
+        args = I2cSmbusIoctlData(rw, cmd, size, ctypes.pointer(data))
+        fcntl.ioctl(self.fd, I2C_SMBUS, args)
+
+    def readbyte(self, dimmaddr, addr):
+        data = I2cSmbusData()
+        self.smbus(dimmaddr, I2C_SMBUS_READ, addr, I2C_SMBUS_BYTE_DATA, data)
+        return data.byte
+
+    def writebyte(self, dimmaddr, addr, byte):
+        data = I2cSmbusData()
+        data.byte = byte
+        self.smbus(dimmaddr, I2C_SMBUS_WRITE, addr, I2C_SMBUS_BYTE_DATA, data)
+
+    def readblock(self, dimmaddr, addr, length):
+        if not self.functionality() & I2C_FUNC_SMBUS_READ_I2C_BLOCK:
+            raise OSError(errno.EOPNOTSUPP, 'I2C block read is not supported')
+        data = I2cSmbusData()
+        data.block[0] = length
+        self.smbus(dimmaddr, I2C_SMBUS_READ, addr, I2C_SMBUS_I2C_BLOCK_DATA, data)
+        return bytes(data.block[1:length + 1])
+
+class I2cToolsBus:
+    # Fallback: spawn `i2cget`/`i2cset` for every transaction.
+    simulated = False
+
+    def __init__(self, busnum):
+        self.busnum = busnum
+
+    def close(self):
+        pass
+
+    def run(self, tool, args):
+        try:
+            i2cproc = subprocess.Popen([tool, '-y', str(self.busnum)] + args
+            , stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = i2cproc.communicate(None, 10)
+        except Exception:
+            raise OSError(0, '{} process error'.format(tool))
+        if i2cproc.returncode != 0:
+            raise OSError(i2cproc.returncode, '{} error'.format(tool))
+        return out
+
+    def readbyte(self, dimmaddr, addr):
+        out = self.run('i2cget', [hex(dimmaddr), hex(addr)])
+        if out[:2].decode().lower() != '0x':
+            raise OSError(0, 'i2cget process error')
+        return int(out.decode().strip(), 16)
+
+    def writebyte(self, dimmaddr, addr, byte):
+        self.run('i2cset', [hex(dimmaddr), hex(addr), hex(byte)])
+
+    def readblock(self, dimmaddr, addr, length):
+        # Older `i2cget` has no block mode: any failure
+        # here is treated as the mode being unsupported.
+        try:
+            out = self.run('i2cget', [hex(dimmaddr), hex(addr), 'i', str(length)])
+            data = bytes(int(x, 16) for x in out.decode().split())
+        except (OSError, ValueError):
+            raise OSError(errno.EOPNOTSUPP, 'I2C block read is not supported')
+        if len(data) != length:
+            raise OSError(errno.EOPNOTSUPP, 'I2C block read is not supported')
+        return data
+
+class FakeSpd:
+    # Bare minimum of SPD5118 hub behavior: MR11 virtual page
+    # and MR12/MR13 write protection of 64-byte blocks.
+    def __init__(self, data=None):
+        if data is None:
+            data = b'\xff' * 1024
+        self.eeprom = bytearray(data)
+        self.regs = bytearray(128)
+        self.regs[0] = 0x51 # device type: SPD5118
+        self.regs[1] = 0x18
+
+    def read(self, addr):
+        if addr & 0x80:
+            return self.eeprom[(self.regs[0xb] & 7) * 128 + (addr & 0x7f)]
+        return self.regs[addr]
+
+    def write(self, addr, byte):
+        if addr & 0x80:
+            idx = (self.regs[0xb] & 7) * 128 + (addr & 0x7f)
+            block = idx // 64
+            if (self.regs[0xc + block // 8] >> (block % 8)) & 1:
+                return # silently ignored by write protected hub
+            self.eeprom[idx] = byte
+        elif addr in (0xc, 0xd):
+            self.regs[addr] |= byte # RSWP bits can only be set
+        else:
+            self.regs[addr] = byte
+
+class FakeBus:
+    # Pure Python bus for running the tools without hardware.
+    # It has nothing to share with other processes.
+    simulated = True
+
+    def __init__(self, busnum=0, devices=None, blockread=True):
+        self.busnum = busnum
+        self.devices = devices if devices is not None else {}
+        self.blockread = blockread
+
+    def close(self):
+        pass
+
+    def device(self, dimmaddr):
+        dev = self.devices.get(dimmaddr)
+        if dev is None:
+            raise OSError(errno.ENXIO, 'No such device')
+        return dev
+
+    def readbyte(self, dimmaddr, addr):
+        return self.device(dimmaddr).read(addr)
+
+    def writebyte(self, dimmaddr, addr, byte):
+        self.device(dimmaddr).write(addr, byte)
+
+    def readblock(self, dimmaddr, addr, length):
+        if not self.blockread:
+            raise OSError(errno.EOPNOTSUPP, 'I2C block read is not supported')
+        dev = self.device(dimmaddr)
+        return bytes(dev.read(addr + n) for n in range(0, length))
+
+# Simulated timing: SMBus at 100 kHz and SPD5118 write cycle
+SPD_SIM_LATENCY = 0.0003 # per transaction (start, addresses, stop)
+SPD_SIM_BYTE_TIME = 0.00009 # per data byte
+SPD_SIM_WRITE_CYCLE = 0.005
+SPD_SIM_DIMM_ADDR = 0x51
+
+class SimSpd(FakeSpd):
+    # SPD5118 hub with an internal write cycle: while it runs,
+    # MR48 reports the hub busy and any other access is NACKed.
+    # Read bit errors can be injected (`bitrate` per byte).
+    def __init__(self, data=None, writecycle=SPD_SIM_WRITE_CYCLE, bitrate=0, seed=None):
+        FakeSpd.__init__(self, data)
+        self.writecycle = writecycle
+        self.bitrate = bitrate
+        self.random = random.Random(seed)
+        self.busyuntil = 0
+        self.writes = 0
+
+    def busy(self):
+        return monotonic() < self.busyuntil
+
+    def read(self, addr):
+        if addr == 0x30:
+            return self.regs[addr] | 0x8 if self.busy() else self.regs[addr] & ~0x8
+        if self.busy():
+            raise OSError(errno.ENXIO, 'NACK')
+        byte = FakeSpd.read(self, addr)
+        if addr & 0x80 and self.bitrate != 0 and self.random.random() < self.bitrate:
+            byte ^= 1 << self.random.randrange(0, 8)
+        return byte
+
+    def write(self, addr, byte):
+        if self.busy():
+            raise OSError(errno.ENXIO, 'NACK')
+        FakeSpd.write(self, addr, byte)
+        if addr & 0x80 or addr in (0xc, 0xd):
+            self.busyuntil = monotonic() + self.writecycle
+            self.writes += 1
+
+class SimBus(FakeBus):
+    # FakeBus taking as long as a real SMBus would, with
+    # transaction statistics and injectable NACKs (`nackrate`
+    # per transaction, on top of those from busy hubs).
+    def __init__(self, busnum=0, devices=None, blockread=True, latency=SPD_SIM_LATENCY
+    , bytetime=SPD_SIM_BYTE_TIME, nackrate=0, seed=None):
+        FakeBus.__init__(self, busnum, devices, blockread)
+        self.latency = latency
+        self.bytetime = bytetime
+        self.nackrate = nackrate
+        self.random = random.Random(seed)
+        self.transactions = 0
+        self.bytes = 0
+
+    def transfer(self, length):
+        self.transactions += 1
+        sleep(self.latency + length * self.bytetime)
+        if self.nackrate != 0 and self.random.random() < self.nackrate:
+            raise OSError(errno.ENXIO, 'NACK (injected)')
+        self.bytes += length
+
+    def readbyte(self, dimmaddr, addr):
+        self.transfer(1)
+        return FakeBus.readbyte(self, dimmaddr, addr)
+
+    def writebyte(self, dimmaddr, addr, byte):
+        self.transfer(1)
+        FakeBus.writebyte(self, dimmaddr, addr, byte)
+
+    def readblock(self, dimmaddr, addr, length):
+        if not self.blockread:
+            raise OSError(errno.EOPNOTSUPP, 'I2C block read is not supported')
+        self.transfer(length)
+        dev = self.device(dimmaddr)
+        return bytes(dev.read(addr + n) for n in range(0, length))
+
+def simbus(busnum, image=None):
+    # `sim:<image>` backend: a single hub holding the image
+    data = None
+    if image is not None:
+        with open(image, 'rb') as file:
+            data = file.read()
+    return SimBus(busnum, {SPD_SIM_DIMM_ADDR: SimSpd(data)})
+
+SPD_BUS_BACKENDS = {
+    'i2cdev': I2cDevBus,
+    'i2ctools': I2cToolsBus,
+    'fake': FakeBus,
+    'sim': simbus
+}
+
+def openbus(busnum, backend='auto'):
+    # Backend name, optionally followed by `:<argument>`
+    if backend == 'auto':
+        backend = 'i2ctools'
+        if fcntl is not None and os.path.exists('/dev/i2c-{}'.format(busnum)):
+            backend = 'i2cdev'
+    name, sep, arg = backend.partition(':')
+    if sep == '':
+        return SPD_BUS_BACKENDS[name](busnum)
+    return SPD_BUS_BACKENDS[name](busnum, arg)
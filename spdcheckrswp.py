@@ -2,70 +2,114 @@
 
 import os
 import sys
+import json
 import getopt
 
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, checkroot, checkddr5, setbackend, rswpblocksget, detectspd \
+, SpdDevice, printerr, SPD_RSWP_BLOCKS
+
 def usage():
-    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --help')
+    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> | --all [--bus <busnum>[,...]] --json --yes --backend <auto|i2cdev|i2ctools> --help')
     sys.exit(1)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'help'])
+        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'all', 'json', 'yes', 'backend=', 'help'])
     except getopt.GetoptError:
         usage()
 
-    bus = -1
+    buses = []
     dimm = -1
+    detect = False
+    tojson = False
+    yes = False
+    backend = 'auto'
     for opt, arg in opts:
         try:
             if opt in ('-h', '--help'):
-                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr>')
+                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> | --all [--bus <busnum>[,...]] --json --yes --backend <auto|i2cdev|i2ctools>')
                 print('  -b --bus: bus number (0)')
                 print('  -d --dimm: dimm address on the bus (0x51)')
+                print('  --all: every SPD hub detected on the SMBus adapter(s), one line each.')
+                print('    (`P` marks protected blocks, `.` writable ones.)')
+                print('  --json: print one JSON object per DIMM instead.')
+                print('  --yes: do not ask for confirmation.')
+                print('  --backend: SMBus access method (auto)')
+                print('    (`i2cdev` talks to /dev/i2c-N directly, `i2ctools` runs `i2cget`/`i2cset`.)')
+                print('')
+                print('Only the two RSWP registers are read from each DIMM.')
                 sys.exit(0)
             elif opt in ('-b', '--bus'):
-                bus = optint(arg)
+                buses = [optint(bus) for bus in arg.split(',')]
             elif opt in ('-d', '--dimm'):
                 dimm = opthex(arg)
+            elif opt in ('--all'):
+                detect = True
+            elif opt in ('--json'):
+                tojson = True
+            elif opt in ('--yes'):
+                yes = True
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
         except:
             usage()
-    if bus < 0 or bus > 99 \
-    or dimm < 0x50 or dimm > 0x57:
+    if detect == (dimm != -1) \
+    or not detect and len(buses) != 1 \
+    or any(bus < 0 or bus > 99 for bus in buses) \
+    or not detect and (dimm < 0x50 or dimm > 0x57):
         usage()
 
+    setbackend(backend)
     checkroot()
     checkddr5()
-    checkrswp(bus, dimm)
+    if detect:
+        targets = detectspd(buses)
+    else:
+        targets = [(buses[0], dimm)]
+    checkrswp(targets, tojson, yes, detect)
 
-def checkrswp(busnum, dimmaddr):
-    print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
-    print('Will now read from device file /dev/i2c-{}, chip address {}, byte-by-byte.\n'
-    .format(busnum, hex(dimmaddr)))
+def checkrswp(targets, tojson=False, yes=False, table=False):
+    # Nothing but the status goes to `stdout` with JSON output
+    out = printerr if tojson else print
+    out('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
+    for busnum, dimmaddr in targets:
+        out('Will now read from device file /dev/i2c-{}, chip address {}, byte-by-byte.'.format(busnum, hex(dimmaddr)))
+    out('')
 
-    go = input('Continue? (yes/no): ').lower()
-    print('')
+    go = 'yes'
+    if not yes:
+        go = input('Continue? (yes/no): ').lower()
+        out('')
     if go in ['yes']:
-        print('RSWP status for blocks #{}..{} on DIMM {}:'.format(0, 15, hex(dimmaddr)))
-        for idx in range(0, 15 + 1):
-            rswpblockget(busnum, dimmaddr, idx)
+        if table and not tojson:
+            print('Bus  DIMM  RSWP {}'.format(''.join('{:x}'.format(block) for block in range(0, SPD_RSWP_BLOCKS))))
+        for busnum, dimmaddr in targets:
+            with SpdDevice(busnum, dimmaddr) as dev:
+                rswpblocks = rswpblocksget(dev)
+            if tojson:
+                print(json.dumps({
+                    'bus': busnum,
+                    'dimm': hex(dimmaddr),
+                    'protected': [block for block in range(0, SPD_RSWP_BLOCKS) if rswpblocks[block]]
+                }))
+            elif table:
+                print('{0: >3}  {1}  {2: >4} {3}'.format(busnum, hex(dimmaddr), rswpblocks.count(True)
+                , ''.join('P' if protected else '.' for protected in rswpblocks)))
+            else:
+                rswpreport(dimmaddr, rswpblocks)
     else:
-        print('Exiting without performing any operations on SMBus.')
+        out('Exiting without performing any operations on SMBus.')
         sys.exit(0)
 
 RSWP_STATUS = ['writable', 'protected'];
 
-def rswpblockget(busnum, dimmaddr, block):
-    mreg = SPD_MREG_RSWP_FIRST + int(block >= 8)
-    blockidx = block % 8
-    out = i2cget(busnum, dimmaddr, mreg)
-    out = out[2:].decode()
-    byte = bytes.fromhex(out)[0]
-    print('Block {0: >3} RSWP status: {1}'.format('#' + str(block)
-    , RSWP_STATUS[(byte >> blockidx) & 1]))
+def rswpreport(dimmaddr, rswpblocks):
+    print('RSWP status for blocks #{}..{} on DIMM {}:'.format(0, SPD_RSWP_BLOCKS - 1, hex(dimmaddr)))
+    for block in range(0, SPD_RSWP_BLOCKS):
+        print('Block {0: >3} RSWP status: {1}'.format('#' + str(block)
+        , RSWP_STATUS[int(rswpblocks[block])]))
 
 if __name__ == '__main__':
-    if __package__ == None:
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from spdcommon import optint, opthex, checkroot, checkddr5, i2cget, printerr \
-    , SPD_MREG_RSWP_FIRST
     main(sys.argv[1:])
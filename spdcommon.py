@@ -1,18 +1,44 @@
 import os
 import sys
+import json
+import errno
+import struct
+import atexit
+import statistics
+import datetime
+import tempfile
 import subprocess
 from pathlib import Path
-from time import sleep
+from time import sleep, monotonic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from spdbus import openbus, SPD_BUS_BACKENDS, SPD_BUS_UNSUPPORTED, I2C_SMBUS_BLOCK_MAX
 
 SPD_DDR5_EEPROM_SIZE = 1024
 SPD_DDR5_EEPROM_PAGE_SIZE = 128
 SPD_DDR5_EEPROM_BLOCK_SIZE = 64
 
+EEPROM_DUMP_FILE_EXT = 'spd'
+SPD_ARCHIVE_FILE_EXT = 'spda'
+
 SPD_MREG_VIRTUAL_PAGE = 0xb
 SPD_MREG_RSWP_FIRST = 0xc
+SPD_MREG_DEVICE_STATUS = 0x30
 SPD_MREG_DATA = 0x80
 
+SPD_MREG_DEVICE_TYPE = 0x0
+SPD_DEVICE_TYPE_SPD5118 = 0x5118
+SPD_DEVICE_STATUS_WRITE_BUSY = 0x8
+
+SPD_DIMM_ADDR_FIRST = 0x50
+SPD_DIMM_ADDR_LAST = 0x57
+
 SPD_IO_DELAY = 0.1 # 100 milliseconds
+SPD_IO_POLL_INTERVAL = 0.001
+SPD_IO_BLOCK_SIZE = I2C_SMBUS_BLOCK_MAX
 
 def optint(arg):
     return int(arg)
@@ -27,7 +53,28 @@ def optintx(arg):
         return int(arg, 16)
     return int(arg, 10)
 
+def optwritepoll(arg):
+    if arg not in SPD_WRITE_POLL_MODES:
+        raise ValueError('Unknown write completion mode: "{}"'.format(arg))
+    return arg
+
+def opttraceformat(arg):
+    if arg not in SPD_TRACE_FORMATS:
+        raise ValueError('Unknown trace format: "{}"'.format(arg))
+    return arg
+
+def optbackend(arg):
+    if arg != 'auto' and arg.partition(':')[0] not in SPD_BUS_BACKENDS:
+        raise ValueError('Unknown bus backend: "{}"'.format(arg))
+    return arg
+
+def simulated():
+    # No real hardware is involved
+    return SPD_BUS_BACKEND.partition(':')[0] in ('fake', 'sim')
+
 def checkroot():
+    if simulated():
+        return
     if os.getuid():
         printerr('Access is denied.')
         sys.exit(1)
@@ -37,24 +84,18 @@ def checkddr5():
     # to determinte DDR RAM type because it might be already corrupted.
     # Instead, we are querying SMBIOS to check if DDR5 RAM is in use.
     # (And it is much safer to do it like this anyway.)
-    try:
-        i2cproc = subprocess.Popen(['dmidecode', '--type', '17']
-        , stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = i2cproc.communicate(None, 10)
-    except:
+    if simulated():
+        return
+    slots = memoryslots()
+    if slots is None:
         printerr('`dmidecode` failure.')
         sys.exit(1)
 
-    out = out.decode().splitlines()
     isddr5 = False
-    for lns in out:
-        ln = lns.strip().lower()
-        pos = ln.find(':')
-        if pos != -1:
-            if ln[pos-4:pos] == 'type':
-                if ln[-4:] == 'ddr5':
-                    isddr5 = True
-                    break
+    for slot in slots:
+        if slot['type'] is not None and slot['type'].lower()[-4:] == 'ddr5':
+            isddr5 = True
+            break
 
     if not isddr5:
         printerr('This tool is meant to be used with DDR5 RAM ONLY.')
@@ -62,8 +103,110 @@ def checkddr5():
         printerr('It WILL result in corruption and hardware failure of your RAM device.')
         sys.exit(1)
 
+SMBIOS_TABLE_FILE = '/sys/firmware/dmi/tables/DMI'
+SMBIOS_TYPE_MEMORY_DEVICE = 17
+SMBIOS_TYPE_END = 127
+SMBIOS_MEMORY_TYPES = {
+    0x12: 'DDR', 0x13: 'DDR2', 0x18: 'DDR3', 0x1a: 'DDR4', 0x1b: 'LPDDR', 0x1c: 'LPDDR2',
+    0x1d: 'LPDDR3', 0x1e: 'LPDDR4', 0x20: 'HBM', 0x21: 'HBM2', 0x22: 'DDR5', 0x23: 'LPDDR5', 0x24: 'HBM3'
+}
+
+# SMBIOS memory devices, read once per run
+SPD_MEMORY_SLOTS = None
+
+def memoryslots():
+    # [{locator, bank, type, size (MB, 0 if empty, `None` if unknown),
+    # manufacturer, partnumber, serial}, ...] for every memory slot,
+    # `None` if neither SMBIOS tables nor `dmidecode` are available
+    global SPD_MEMORY_SLOTS
+    if SPD_MEMORY_SLOTS is None:
+        try:
+            with open(SMBIOS_TABLE_FILE, 'rb') as file:
+                SPD_MEMORY_SLOTS = smbiosslots(file.read())
+        except (OSError, struct.error, IndexError, ValueError):
+            # Truncated or malformed table
+            SPD_MEMORY_SLOTS = dmidecodeslots()
+    return SPD_MEMORY_SLOTS
+
+def populatedslots():
+    return [slot for slot in memoryslots() or [] if slot['size'] != 0]
+
+def smbiosslots(data):
+    # Type 17 (Memory Device) structures of raw SMBIOS tables
+    slots = []
+    off = 0
+    while off + 4 <= len(data):
+        stype, length = struct.unpack_from('<BB', data, off)
+        # Strings (numbered from 1) follow the formatted area up to a double null
+        end = data.index(b'\0\0', off + length)
+        strings = data[off + length:end].split(b'\0')
+        def string(idx):
+            if idx == 0 or idx > len(strings):
+                return None
+            return strings[idx - 1].decode(errors='replace').strip()
+        if stype == SMBIOS_TYPE_END:
+            break
+        if stype == SMBIOS_TYPE_MEMORY_DEVICE and length >= 0x1b:
+            size = struct.unpack_from('<H', data, off + 0xc)[0]
+            if size == 0xffff:
+                size = None
+            elif size == 0x7fff and length >= 0x20:
+                size = struct.unpack_from('<I', data, off + 0x1c)[0] & 0x7fffffff
+            elif size & 0x8000:
+                size = (size & 0x7fff) // 1024 # KB
+            slots.append({
+                'locator': string(data[off + 0x10]),
+                'bank': string(data[off + 0x11]),
+                'type': SMBIOS_MEMORY_TYPES.get(data[off + 0x12], 'Unknown'),
+                'size': size,
+                'manufacturer': string(data[off + 0x17]),
+                'partnumber': string(data[off + 0x1a]),
+                'serial': string(data[off + 0x18])
+            })
+        off = end + 2
+    return slots
+
+def dmidecodeslots():
+    # Same from `dmidecode` output, for systems without SMBIOS tables in sysfs
+    try:
+        i2cproc = subprocess.Popen(['dmidecode', '--type', '17']
+        , stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = i2cproc.communicate(None, 10)
+    except:
+        return None
+    fields = {
+        'locator': 'locator', 'bank locator': 'bank', 'type': 'type', 'size': 'size',
+        'manufacturer': 'manufacturer', 'part number': 'partnumber', 'serial number': 'serial'
+    }
+    slots = []
+    for lns in out.decode(errors='replace').splitlines():
+        ln = lns.strip()
+        if ln == 'Memory Device':
+            slots.append(dict.fromkeys(fields.values()))
+            continue
+        pos = ln.find(':')
+        if len(slots) == 0 or pos == -1 or ln[:pos].lower() not in fields:
+            continue
+        key = fields[ln[:pos].lower()]
+        value = ln[pos + 1:].strip()
+        if key == 'size':
+            amount = value.split()
+            if len(amount) == 2 and amount[0].isdigit():
+                value = int(amount[0]) * {'kB': 1 / 1024, 'MB': 1, 'GB': 1024, 'TB': 1024 * 1024}.get(amount[1], 0)
+                value = int(value)
+            else:
+                value = 0 if value.startswith('No Module') else None
+        slots[-1][key] = value
+    return slots
+
 def readspdfile(filepath):
     pathfile = Path(filepath)
+    member = str(filepath).find('.{}#'.format(SPD_ARCHIVE_FILE_EXT))
+    if member != -1 and not pathfile.is_file():
+        # `<archive>.spda#<member>`, see `spdarchive.py`
+        from spdarchive import readmember
+        member += len(SPD_ARCHIVE_FILE_EXT) + 1
+        return readmember(str(filepath)[:member], str(filepath)[member + 1:])
     if not pathfile.is_file():
         printerr('File not found: "{}".'.format(filepath))
         sys.exit(1)
@@ -85,63 +228,554 @@ def readspdfile(filepath):
     file.close()
     return data
 
-BUSNUM_FOR_PAGE_RESET = None
-DIMMADDR_FOR_PAGE_RESET = None
-EEPROM_VIRT_PAGE_SWITCHED_FROM_ZERO = False
+def writespdfile(filepath, data):
+    # Write to a temporary file first and rename it over the target,
+    # so that an interrupted dump never leaves a truncated file behind.
+    pathfile = Path(filepath)
+    tmpfile = pathfile.with_name('.{}.tmp'.format(pathfile.name))
+    try:
+        file = open(tmpfile, 'wb')
+    except:
+        printerr('Could not open file "{}" for writing.'.format(filepath))
+        sys.exit(1)
+    try:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(tmpfile, pathfile)
+    except:
+        printerr('I/O error.')
+        file.close()
+        tmpfile.unlink(missing_ok=True)
+        sys.exit(1)
+
+SPD_BUS_BACKEND = 'auto'
+SPD_BUSES = {}
+
+def setbackend(backend):
+    global SPD_BUS_BACKEND
+    backend = optbackend(backend)
+    if backend != SPD_BUS_BACKEND:
+        # Buses opened earlier in the same process belong to the old backend
+        for bus in SPD_BUSES.values():
+            bus.close()
+        SPD_BUSES.clear()
+    SPD_BUS_BACKEND = backend
 
-def selectpage(busnum, dimmaddr, pagenum):
-    if pagenum < 0 or pagenum > 7:
-        # This is never supposed to happen
-        selectpage(busnum, dimmaddr, 0)
+def setbus(busnum, bus):
+    # Plug in an already opened bus (e.g. `spdbus.FakeBus`)
+    SPD_BUSES[busnum] = bus
+
+def getbus(busnum):
+    bus = SPD_BUSES.get(busnum)
+    if bus is None:
+        bus = openbus(busnum, SPD_BUS_BACKEND)
+        SPD_BUSES[busnum] = bus
+    return bus
+
+def smbusadapters():
+    # Numbers of all SMBus controllers known to the kernel
+    buses = []
+    for path in Path('/sys/class/i2c-adapter').glob('i2c-*'):
+        try:
+            name = (path / 'name').read_text()
+        except OSError:
+            continue
+        if name.startswith('SMBus'):
+            buses.append(int(path.name[4:]))
+    return sorted(buses)
+
+def probespd(busnum):
+    # Addresses of SPD5118 hubs responding on the bus.
+    # Only the read-only device type registers are accessed.
+    found = []
+    try:
+        bus = getbus(busnum)
+    except OSError:
+        return found
+    for dimmaddr in range(SPD_DIMM_ADDR_FIRST, SPD_DIMM_ADDR_LAST + 1):
+        try:
+            devtype = bus.readbyte(dimmaddr, SPD_MREG_DEVICE_TYPE) << 8 \
+            | bus.readbyte(dimmaddr, SPD_MREG_DEVICE_TYPE + 1)
+        except OSError:
+            continue
+        if devtype == SPD_DEVICE_TYPE_SPD5118:
+            found.append(dimmaddr)
+    return found
+
+def detectspd(buses):
+    # [(bus, address), ...] of the SPD hubs on the given buses
+    # (all SMBus adapters if none are given)
+    if len(buses) == 0:
+        buses = smbusadapters()
+    found = []
+    for busnum in buses:
+        for dimmaddr in probespd(busnum):
+            found.append((busnum, dimmaddr))
+    if len(found) == 0:
+        printerr('No DDR5 SPD hubs detected.')
         sys.exit(1)
-    i2cset(busnum, dimmaddr, SPD_MREG_VIRTUAL_PAGE, pagenum)
-    BUSNUM_FOR_PAGE_RESET = busnum
-    DIMMADDR_FOR_PAGE_RESET = dimmaddr
-    EEPROM_VIRT_PAGE_SWITCHED_FROM_ZERO = pagenum != 0
+    return found
 
 def i2cget(busnum, dimmaddr, addr):
+    start = monotonic()
     try:
-        i2cproc = subprocess.Popen(['i2cget', '-y', str(busnum), hex(dimmaddr)
-        , hex(addr)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = i2cproc.communicate(None, 10)
-    except:
-        i2cfail('i2cget', 0)
-    if i2cproc.returncode != 0:
-        i2cfail('i2cget', i2cproc.returncode)
-    if out[:2].decode().lower() != '0x':
-        i2cfail('i2cget', 0)
-    return out
+        byte = getbus(busnum).readbyte(dimmaddr, addr)
+    except OSError as e:
+        trace('i2cget', busnum, dimmaddr, addr, 1, start, result=e.errno or 0)
+        i2cfail('i2cget', e.errno or 0, busnum)
+    trace('i2cget', busnum, dimmaddr, addr, 1, start)
+    return byte
+
+def i2cgetblock(busnum, dimmaddr, addr, length):
+    # Returns `None` if the adapter rejects I2C block reads
+    start = monotonic()
+    try:
+        data = getbus(busnum).readblock(dimmaddr, addr, length)
+    except OSError as e:
+        trace('i2cgetblock', busnum, dimmaddr, addr, length, start, result=e.errno or 0)
+        if e.errno in SPD_BUS_UNSUPPORTED:
+            return None
+        i2cfail('i2cget', e.errno or 0, busnum)
+    trace('i2cgetblock', busnum, dimmaddr, addr, length, start)
+    return data
+
+# How to wait for EEPROM write completion:
+#   status: poll MR48 "write in progress" bit (NACKs count as busy);
+#   ack: poll until the hub acknowledges a read again;
+#   fixed: always sleep `SPD_IO_DELAY` after every write.
+SPD_WRITE_POLL_MODES = ['status', 'ack', 'fixed']
+SPD_WRITE_POLL = 'status'
+SPD_WRITE_TIMEOUT = SPD_IO_DELAY
+SPD_WRITE_TIMES = []
+
+def setwritepoll(mode, timeout=None):
+    global SPD_WRITE_POLL, SPD_WRITE_TIMEOUT
+    SPD_WRITE_POLL = optwritepoll(mode)
+    if timeout is not None:
+        SPD_WRITE_TIMEOUT = timeout
 
 def i2cset(busnum, dimmaddr, addr, byte):
+    start = monotonic()
     try:
-        i2cproc = subprocess.Popen(['i2cset', '-y', str(busnum), hex(dimmaddr)
-        , hex(addr), hex(byte)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = i2cproc.communicate(None, 10)
-    except:
-        i2cfail('i2cset', 0)
-    if i2cproc.returncode != 0:
-        i2cfail('i2cset', i2cproc.returncode)
-    sleep(SPD_IO_DELAY) # writing through SMBus requires some delay
-    return out
+        getbus(busnum).writebyte(dimmaddr, addr, byte)
+    except OSError as e:
+        trace('i2cset', busnum, dimmaddr, addr, 1, start, result=e.errno or 0)
+        i2cfail('i2cset', e.errno or 0, busnum)
+    wait = monotonic()
+    polls = 0
+    if SPD_WRITE_POLL == 'fixed':
+        sleep(SPD_IO_DELAY) # writing through SMBus requires some delay
+    elif addr != SPD_MREG_VIRTUAL_PAGE:
+        # Page switch takes effect immediately, but EEPROM
+        # (and RSWP bits which are non-volatile, too) need
+        # to wait for the internal write cycle to complete.
+        polls = i2cwait(busnum, dimmaddr)
+    trace('i2cset', busnum, dimmaddr, addr, 1, start, monotonic() - wait, polls)
+
+def i2cwait(busnum, dimmaddr):
+    # Returns the number of status polls it took
+    bus = getbus(busnum)
+    start = monotonic()
+    polls = 0
+    while True:
+        polls += 1
+        try:
+            status = bus.readbyte(dimmaddr, SPD_MREG_DEVICE_STATUS)
+            busy = SPD_WRITE_POLL == 'status' and status & SPD_DEVICE_STATUS_WRITE_BUSY
+        except OSError:
+            busy = True
+        elapsed = monotonic() - start
+        if not busy:
+            break
+        if elapsed > SPD_WRITE_TIMEOUT:
+            printerr('Write cycle did not complete in {} ms.'.format(round(SPD_WRITE_TIMEOUT * 1000)))
+            trace('i2cwait', busnum, dimmaddr, SPD_MREG_DEVICE_STATUS, 0, start, elapsed, polls, errno.ETIMEDOUT)
+            i2cfail('i2cset', errno.ETIMEDOUT, busnum)
+        sleep(SPD_IO_POLL_INTERVAL)
+    SPD_WRITE_TIMES.append(elapsed)
+    return polls
+
+def writetimes():
+    # Write completion statistics: count, median and max (seconds)
+    if len(SPD_WRITE_TIMES) == 0:
+        return 0, 0, 0
+    return len(SPD_WRITE_TIMES), statistics.median(SPD_WRITE_TIMES), max(SPD_WRITE_TIMES)
+
+def writeestimate(writes, switches):
+    # Upper bound of time spent waiting on writes
+    if SPD_WRITE_POLL == 'fixed':
+        return (writes + switches) * SPD_IO_DELAY
+    return writes * SPD_WRITE_TIMEOUT
+
+# Bus locks shared with other processes using these tools: held for
+# as long as the page register may be anything but the first page
+SPD_LOCK_DIRS = ['/run/lock', tempfile.gettempdir()]
+SPD_LOCK_FILE = 'spd-i2c-{}.lock'
+SPD_LOCK_TIMEOUT = 60 # seconds to wait for another process to finish
+SPD_LOCK_POLL_INTERVAL = 0.1
+SPD_LOCKS = {}
+
+def setlocktimeout(timeout):
+    global SPD_LOCK_TIMEOUT
+    SPD_LOCK_TIMEOUT = timeout
+
+def lockpath(busnum):
+    for dirpath in SPD_LOCK_DIRS:
+        if os.access(dirpath, os.W_OK):
+            return Path(dirpath) / SPD_LOCK_FILE.format(busnum)
+    return None
+
+def lockholder(file):
+    # What the last process to take the lock wrote into it
+    try:
+        file.seek(0)
+        holder = json.loads(file.read())
+        return holder if isinstance(holder, dict) else None
+    except (OSError, ValueError):
+        return None
+
+def pidalive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to someone else
+        pass
+    return True
+
+def holderstring(holder):
+    if holder is None:
+        return 'another process'
+    return 'pid {} ({}, DIMM {}) since {}'.format(holder.get('pid'), holder.get('tool'), holder.get('dimm')
+    , holder.get('since'))
+
+def buslock(busnum, dimmaddr):
+    # Waits for exclusive use of the bus. Locks are re-entrant within
+    # the process and die with it, so a crashed tool never blocks others.
+    if fcntl is None or simulated() or getattr(SPD_BUSES.get(busnum), 'simulated', False):
+        # Including simulated buses plugged in with `setbus()`
+        return
+    lock = SPD_LOCKS.get(busnum)
+    if lock is not None:
+        lock[1] += 1
+        return
+    path = lockpath(busnum)
+    if path is None:
+        return
+    try:
+        file = open(path, 'a+')
+    except OSError:
+        printerr('Could not open lock file "{}".'.format(path))
+        sys.exit(1)
+    start = monotonic()
+    waiting = False
+    while True:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            pass
+        holder = lockholder(file)
+        if not waiting:
+            printerr('Bus {} is in use by {}, waiting...'.format(busnum, holderstring(holder)))
+            waiting = True
+        if monotonic() - start >= SPD_LOCK_TIMEOUT:
+            file.close()
+            printerr('Gave up waiting for bus {} after {} s.'.format(busnum, SPD_LOCK_TIMEOUT))
+            if holder is not None and not pidalive(holder.get('pid', 0)):
+                # The lock is still held open by a child the holder left behind
+                printerr('Holder pid {} is gone, look for processes keeping "{}" open.'.format(holder.get('pid'), path))
+            sys.exit(1)
+        sleep(SPD_LOCK_POLL_INTERVAL)
+    holder = lockholder(file)
+    if holder is not None and holder.get('pid') != os.getpid():
+        # Only a holder which didn't exit normally leaves its record behind
+        printerr('Stale lock on bus {} from {} taken over.'.format(busnum, holderstring(holder)))
+        printerr('Its DIMM may have been left on a page other than the first!')
+    file.seek(0)
+    file.truncate()
+    file.write(json.dumps({
+        'pid': os.getpid(),
+        'tool': os.path.basename(sys.argv[0]),
+        'dimm': hex(dimmaddr),
+        'since': datetime.datetime.now().isoformat(timespec='seconds')
+    }))
+    file.flush()
+    if waiting:
+        printerr('Bus {} acquired after {:.1f} s.'.format(busnum, monotonic() - start))
+    SPD_LOCKS[busnum] = [file, 1]
+
+def busunlock(busnum, clean=True):
+    # The holder record is left behind for the next process to warn
+    # about when the page couldn't be restored
+    lock = SPD_LOCKS.get(busnum)
+    if lock is None:
+        return
+    lock[1] -= 1
+    if lock[1] != 0:
+        return
+    del SPD_LOCKS[busnum]
+    if clean:
+        try:
+            lock[0].truncate(0)
+        except OSError:
+            pass
+    lock[0].close()
+
+# SPD hubs currently open for page restore by `i2cfail()`
+SPD_DEVICES = {}
+
+class SpdDevice:
+    # Session with a single SPD hub: keeps track of the
+    # virtual page selected through MR11 so that it is only
+    # written when the page actually changes, and switches
+    # back to the first page on exit, exceptions included.
+    def __init__(self, busnum, dimmaddr):
+        self.busnum = busnum
+        self.dimmaddr = dimmaddr
+        self.page = None
+        self.failed = False
+
+    def __enter__(self):
+        buslock(self.busnum, self.dimmaddr)
+        SPD_DEVICES[self.busnum] = self
+        try:
+            self.page = self.readreg(SPD_MREG_VIRTUAL_PAGE) & 7
+        except BaseException:
+            del SPD_DEVICES[self.busnum]
+            # MR11 unreadable: the page is unknown
+            busunlock(self.busnum, not self.failed)
+            raise
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        try:
+            # Page restore after an I/O error is up to `i2cfail()`
+            if not self.failed:
+                self.selectpage(0)
+        finally:
+            del SPD_DEVICES[self.busnum]
+            busunlock(self.busnum, not self.failed or self.page == 0)
+
+    def selectpage(self, page):
+        if page < 0 or page > 7:
+            # This is never supposed to happen
+            raise ValueError('Invalid virtual page: {}'.format(page))
+        if page != self.page:
+            start = monotonic()
+            # Unknown until the write is known to have gone through,
+            # so that an interrupted switch is always undone
+            self.page = None
+            i2cset(self.busnum, self.dimmaddr, SPD_MREG_VIRTUAL_PAGE, page)
+            self.page = page
+            trace('selectpage', self.busnum, self.dimmaddr, SPD_MREG_VIRTUAL_PAGE, 0, start)
+
+    def readreg(self, reg):
+        return i2cget(self.busnum, self.dimmaddr, reg)
+
+    def writereg(self, reg, byte):
+        i2cset(self.busnum, self.dimmaddr, reg, byte)
+
+    def readchunk(self, addr, length, block):
+        # I2C block read with a fallback to byte reads
+        # in case the adapter doesn't support the former
+        data = None
+        if block:
+            data = i2cgetblock(self.busnum, self.dimmaddr, addr, length)
+        if data is None:
+            data = bytes(i2cget(self.busnum, self.dimmaddr, addr + n) for n in range(0, length))
+        return data
+
+    def read(self, offset, length, block=True):
+        data = bytearray()
+        end = offset + length
+        idx = offset
+        while idx < end:
+            off = idx % SPD_DDR5_EEPROM_PAGE_SIZE
+            size = min(SPD_IO_BLOCK_SIZE, SPD_DDR5_EEPROM_PAGE_SIZE - off, end - idx)
+            self.selectpage(idx // SPD_DDR5_EEPROM_PAGE_SIZE)
+            data += self.readchunk(SPD_MREG_DATA | off, size, block)
+            idx += size
+        return data
+
+    def write(self, offset, data):
+        for n, byte in enumerate(data):
+            idx = offset + n
+            self.selectpage(idx // SPD_DDR5_EEPROM_PAGE_SIZE)
+            i2cset(self.busnum, self.dimmaddr, SPD_MREG_DATA | (idx % SPD_DDR5_EEPROM_PAGE_SIZE), byte)
+
+# Write protection (RSWP) of the EEPROM blocks: one bit per
+# block, blocks #0..7 in MR12 and blocks #8..15 in MR13
+SPD_RSWP_BLOCKS = SPD_DDR5_EEPROM_SIZE // SPD_DDR5_EEPROM_BLOCK_SIZE
+SPD_RSWP_REGS = 2
+
+def rswpblocksget(dev):
+    rswpblocks = []
+    for reg in range(0, SPD_RSWP_REGS):
+        byte = dev.readreg(SPD_MREG_RSWP_FIRST + reg)
+        for bit in range(0, 8):
+            rswpblocks.append(bool((byte >> bit) & 1))
+    return rswpblocks
+
+def rswpblocksset(dev, blocks, verbose=True):
+    # Sets protection for all the blocks at once: each register
+    # is written at most once, and only if any of its bits change.
+    # Returns the status of all blocks read back afterwards.
+    rswpblocks = rswpblocksget(dev)
+    for reg in range(0, SPD_RSWP_REGS):
+        regblocks = range(reg * 8, reg * 8 + 8)
+        oldbyte = sum(int(rswpblocks[block]) << (block % 8) for block in regblocks)
+        newbyte = oldbyte
+        for block in blocks:
+            if block in regblocks:
+                newbyte |= 1 << (block % 8)
+        if newbyte != oldbyte:
+            if verbose:
+                print('Setting RSWP bits for block(s) {} (register {}, {} -> {})'.format(', '.join('#{}'.format(block)
+                for block in regblocks if (newbyte & ~oldbyte) >> (block % 8) & 1), hex(SPD_MREG_RSWP_FIRST + reg)
+                , hex(oldbyte), hex(newbyte)))
+            # DANGER: no way back after this!
+            dev.writereg(SPD_MREG_RSWP_FIRST + reg, newbyte)
+    return rswpblocksget(dev)
+
+# Optional record of every SMBus transaction, see `settrace()`
+SPD_TRACE_FORMATS = ['jsonl', 'chrome']
+SPD_TRACE = None
+SPD_TRACE_FILE = None
+SPD_TRACE_FORMAT = 'jsonl'
+SPD_TRACE_START = 0
+SPD_TRACE_OPS = ['i2cget', 'i2cgetblock', 'i2cset'] # `selectpage` is made of `i2cset`
 
-def i2cfail(tool, code):
+def settrace(filepath, fmt='jsonl'):
+    # Saved (and summarized) on exit, whichever way it happens
+    global SPD_TRACE, SPD_TRACE_FILE, SPD_TRACE_FORMAT, SPD_TRACE_START
+    SPD_TRACE = []
+    SPD_TRACE_FILE = filepath
+    SPD_TRACE_FORMAT = opttraceformat(fmt)
+    SPD_TRACE_START = monotonic()
+    atexit.unregister(tracefinish)
+    atexit.register(tracefinish)
+
+def trace(op, busnum, dimmaddr, addr, length, start, wait=0, retries=0, result='ok'):
+    if SPD_TRACE is None:
+        return
+    dev = SPD_DEVICES.get(busnum)
+    page = dev.page if dev is not None else None
+    offset = None
+    if addr & SPD_MREG_DATA and page is not None:
+        offset = page * SPD_DDR5_EEPROM_PAGE_SIZE + (addr & ~SPD_MREG_DATA)
+    SPD_TRACE.append({
+        'op': op,
+        'bus': busnum,
+        'dimm': hex(dimmaddr),
+        'addr': hex(addr),
+        'page': page,
+        'offset': offset,
+        'length': length,
+        'start': start - SPD_TRACE_START,
+        'duration': monotonic() - start,
+        'wait': wait,
+        'retries': retries,
+        'result': result
+    })
+
+def percentile(values, fraction):
+    # `values` must be sorted
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+def tracefinish():
+    global SPD_TRACE
+    events = SPD_TRACE
+    SPD_TRACE = None
+    if events is None or len(events) == 0:
+        return
+    if SPD_TRACE_FORMAT == 'chrome':
+        data = json.dumps({'traceEvents': [{
+            'name': event['op'], 'cat': 'smbus', 'ph': 'X', 'pid': event['bus'], 'tid': event['dimm'],
+            'ts': round(event['start'] * 1e6, 1), 'dur': round(event['duration'] * 1e6, 1), 'args': event
+        } for event in events]})
+    else:
+        data = ''.join(json.dumps(event) + '\n' for event in events)
+    try:
+        writespdfile(SPD_TRACE_FILE, data.encode())
+    except SystemExit:
+        pass # already reported
+
+    # From the first transaction on: the trace starts before confirmation is asked for
+    wall = max(event['start'] + event['duration'] for event in events) - min(event['start'] for event in events)
+    leaves = [event for event in events if event['op'] in SPD_TRACE_OPS]
+    waited = sum(event['wait'] for event in leaves)
+    onbus = sum(event['duration'] for event in leaves) - waited
+    transferred = sum(event['length'] for event in leaves if event['result'] == 'ok')
+    print('')
+    print('SMBus trace: {} transaction(s) in {:.2f} s, {:.0f} B/s, written to "{}".'
+    .format(len(leaves), wall, transferred / wall if wall != 0 else 0, SPD_TRACE_FILE))
+    print('  {0: <12} {1: >6} {2: >9} {3: >9} {4: >9} {5: >7}'.format('Operation', 'Count', 'p50 (ms)', 'p95 (ms)', 'max (ms)', 'Errors'))
+    for op in SPD_TRACE_OPS + ['selectpage']:
+        durations = sorted(event['duration'] * 1000 for event in events if event['op'] == op)
+        if len(durations) == 0:
+            continue
+        errors = len([event for event in events if event['op'] == op and event['result'] != 'ok'])
+        print('  {0: <12} {1: >6} {2: >9.2f} {3: >9.2f} {4: >9.2f} {5: >7}'.format(op, len(durations)
+        , percentile(durations, 0.5), percentile(durations, 0.95), durations[-1], errors))
+    print('  Time on the bus: {:.2f} s, waiting for write cycles: {:.2f} s'.format(onbus, waited))
+
+SPD_PROGRESS_INTERVAL = 0.2 # seconds between updates on a terminal
+SPD_PROGRESS_LOG_INTERVAL = 5 # ... and otherwise
+
+class SpdProgress:
+    # Single self-updating status line with an ETA
+    # instead of a line printed for every byte
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.start = monotonic()
+        self.shown = None
+        self.tty = sys.stdout.isatty()
+
+    def update(self, done, detail=''):
+        now = monotonic()
+        if self.shown is not None and done < self.total \
+        and now - self.shown < (SPD_PROGRESS_INTERVAL if self.tty else SPD_PROGRESS_LOG_INTERVAL):
+            return
+        self.shown = now
+        elapsed = now - self.start
+        eta = elapsed / done * (self.total - done) if done != 0 else 0
+        line = '{}: {}/{} byte(s) ({}%){}, ETA {:.1f} s'.format(self.label, done, self.total
+        , done * 100 // self.total if self.total != 0 else 100, ', ' + detail if detail != '' else '', eta)
+        if self.tty:
+            print('\r' + line + '\x1b[K', end='', flush=True)
+        else:
+            print(line)
+
+    def finish(self):
+        if self.tty and self.shown is not None:
+            print('')
+
+def i2cfail(tool, code, busnum=None):
     if code == 0:
         printerr('{} process error, aborting.'.format(tool))
     else:
         printerr('{} error ({}), aborting.'.format(tool, code))
-    if EEPROM_VIRT_PAGE_SWITCHED_FROM_ZERO:
-        recovered = True
-        try:
-            sleep(SPD_IO_DELAY)
-            # Attempt to recover SPD state by switching back to first virtual page
-            i2cproc = subprocess.Popen(['i2cset', '-y', str(BUSNUM_FOR_PAGE_RESET), hex(DIMMADDR_FOR_PAGE_RESET)
-            , hex(SPD_MREG_VIRTUAL_PAGE), hex(0)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output, err = i2cproc.communicate()
-        except:
-            recovered = False
-        recovered = recovered and i2cproc.returncode == 0
-        if not recovered:
-            printerr('SPD EEPROM virtual page is NOT restored to first!')
+    dev = SPD_DEVICES.get(busnum)
+    if dev is not None and not dev.failed:
+        dev.failed = True
+        # Page is unknown if MR11 couldn't be read or written:
+        # the first page is selected then all the same
+        if dev.page != 0:
+            recovered = True
+            try:
+                sleep(SPD_IO_DELAY)
+                # Attempt to recover SPD state by switching back to first virtual page
+                getbus(busnum).writebyte(dev.dimmaddr, SPD_MREG_VIRTUAL_PAGE, 0)
+                dev.page = 0
+            except Exception:
+                recovered = False
+            if not recovered:
+                printerr('SPD EEPROM virtual page is NOT restored to first!')
     printerr('An I/O error occurred while communicating with SPD!')
     printerr('You MUST reboot the system immediately to avoid further data corruption!')
     sys.exit(1 if code == 0 else code)
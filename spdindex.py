@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+import sqlite3
+import hashlib
+from pathlib import Path
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, printerr, SPD_DDR5_EEPROM_SIZE, EEPROM_DUMP_FILE_EXT
+from spdinfo import SpdImage, SPD_CRC_SECTIONS
+
+SPD_INDEX_FILE = 'spdindex.db'
+
+def usage():
+    printerr(sys.argv[0], '--index <dir> | --query [--pn <partnum>] [--manuf <id>] [--size <GB>] [--density <Gb>]'
+    , '[--width <4|8|16>] [--ranks <n>] [--type <type>] [--valid] --db <file> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'h', ['index=', 'query', 'pn=', 'manuf=', 'size=', 'density='
+        , 'width=', 'ranks=', 'type=', 'valid', 'db=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    index = ''
+    query = False
+    where = {}
+    valid = False
+    db = SPD_INDEX_FILE
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--index <dir> | --query [--pn <partnum>] [--manuf <id>] [--size <GB>] [--density <Gb>]'
+                , '[--width <4|8|16>] [--ranks <n>] [--type <type>] [--valid] --db <file>')
+                print('  --index: add all `.spd` files in the directory tree to the index.')
+                print('    (Files unchanged since the last run are skipped.)')
+                print('  --query: list donor dumps matching all of the given criteria.')
+                print('  --pn: part number, `%` matches any characters (UD5-6000%)')
+                print('  --manuf: manufacturer ID as shown by `spdinfo.py` (04ef)')
+                print('  --size: module capacity in GB (16)')
+                print('  --density: SDRAM die density in Gbit (16)')
+                print('  --width: SDRAM I/O width (8)')
+                print('  --ranks: number of package ranks (1)')
+                print('  --type: module type (UDIMM)')
+                print('  --valid: only dumps passing all CRC checks.')
+                print('  --db: index file ({})'.format(SPD_INDEX_FILE))
+                sys.exit(0)
+            elif opt in ('--index'):
+                index = arg
+            elif opt in ('--query'):
+                query = True
+            elif opt in ('--pn'):
+                where['partnumber'] = arg
+            elif opt in ('--manuf'):
+                where['manufacturer'] = arg.lower()
+            elif opt in ('--size'):
+                where['capacity'] = optint(arg)
+            elif opt in ('--density'):
+                where['density'] = optint(arg)
+            elif opt in ('--width'):
+                where['width'] = optint(arg)
+            elif opt in ('--ranks'):
+                where['ranks'] = optint(arg)
+            elif opt in ('--type'):
+                where['moduletype'] = arg.upper()
+            elif opt in ('--valid'):
+                valid = True
+            elif opt in ('--db'):
+                db = arg
+        except:
+            usage()
+    if (index == '') == (not query) \
+    or index != '' and (len(where) != 0 or valid):
+        usage()
+
+    conn = opendb(db)
+    if index != '':
+        indexdir(conn, index)
+    else:
+        querydonors(conn, where, valid)
+    conn.close()
+
+SPD_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT,
+    manufacturer TEXT,
+    year INTEGER,
+    week INTEGER,
+    serial TEXT,
+    partnumber TEXT COLLATE NOCASE,
+    crc TEXT,
+    crcok INTEGER,
+    moduletype TEXT,
+    density INTEGER,
+    dies INTEGER,
+    width INTEGER,
+    ranks INTEGER,
+    capacity INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_partnumber ON images (partnumber);
+CREATE INDEX IF NOT EXISTS images_manufacturer ON images (manufacturer, partnumber);
+CREATE INDEX IF NOT EXISTS images_geometry ON images (capacity, density, width, ranks);
+CREATE INDEX IF NOT EXISTS images_hash ON images (hash);
+'''
+
+SPD_INDEX_COLUMNS = ['path', 'size', 'mtime', 'hash', 'manufacturer', 'year', 'week', 'serial', 'partnumber'
+, 'crc', 'crcok', 'moduletype', 'density', 'dies', 'width', 'ranks', 'capacity']
+
+def opendb(dbpath):
+    try:
+        conn = sqlite3.connect(dbpath)
+        conn.executescript(SPD_INDEX_SCHEMA)
+    except sqlite3.Error as e:
+        printerr('Could not open index "{}": {}.'.format(dbpath, e))
+        sys.exit(1)
+    return conn
+
+def decoderecord(filepath, image, stat):
+    status = image.crcstatus()
+    record = {
+        'path': filepath,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': hashlib.sha256(image.data).hexdigest(),
+        'crc': ' '.join('{}={}'.format(name, status[name]) for name in SPD_CRC_SECTIONS),
+        'crcok': int('fail' not in status.values())
+    }
+    record.update(image.identity)
+    record.update(image.geometry)
+    return record
+
+def indexdir(conn, dirpath):
+    if not Path(dirpath).is_dir():
+        printerr('Directory not found: "{}".'.format(dirpath))
+        sys.exit(1)
+    known = {}
+    for path, size, mtime, digest in conn.execute('SELECT path, size, mtime, hash FROM images'):
+        known[path] = (size, mtime, digest)
+
+    added = 0
+    updated = 0
+    skipped = 0
+    ignored = 0
+    seen = set()
+    for pathfile in sorted(Path(dirpath).rglob('*.{}'.format(EEPROM_DUMP_FILE_EXT))):
+        filepath = str(pathfile.absolute())
+        # Files no longer usable as dumps are forgotten like removed ones
+        try:
+            stat = pathfile.stat()
+        except OSError:
+            ignored += 1
+            continue
+        old = known.get(filepath)
+        if old is not None and old[:2] == (stat.st_size, stat.st_mtime_ns):
+            seen.add(filepath)
+            skipped += 1
+            continue
+        if stat.st_size != SPD_DDR5_EEPROM_SIZE:
+            ignored += 1
+            continue
+        try:
+            data = pathfile.read_bytes()
+        except OSError:
+            ignored += 1
+            continue
+        image = SpdImage(data)
+        if not image.isddr5():
+            ignored += 1
+            continue
+        if old is not None and old[2] == hashlib.sha256(data).hexdigest():
+            # Touched but not modified
+            conn.execute('UPDATE images SET mtime = ? WHERE path = ?', (stat.st_mtime_ns, filepath))
+            seen.add(filepath)
+            skipped += 1
+            continue
+        record = decoderecord(filepath, image, stat)
+        conn.execute('INSERT OR REPLACE INTO images ({}) VALUES ({})'.format(', '.join(SPD_INDEX_COLUMNS)
+        , ', '.join('?' * len(SPD_INDEX_COLUMNS))), [record[column] for column in SPD_INDEX_COLUMNS])
+        seen.add(filepath)
+        if old is None:
+            added += 1
+        else:
+            updated += 1
+
+    # Forget files removed from this tree since the last run
+    prefix = str(Path(dirpath).absolute()) + os.sep
+    removed = [(path,) for path in known if path.startswith(prefix) and path not in seen]
+    conn.executemany('DELETE FROM images WHERE path = ?', removed)
+    conn.commit()
+    print('{} added, {} updated, {} unchanged, {} removed, {} ignored.'
+    .format(added, updated, skipped, len(removed), ignored))
+
+def querydonors(conn, where, valid):
+    clauses = []
+    params = []
+    for column, value in where.items():
+        clauses.append('{} {} ?'.format(column, 'LIKE' if column == 'partnumber' else '='))
+        params.append(value)
+    if valid:
+        clauses.append('crcok = 1')
+    sql = 'SELECT path, manufacturer, partnumber, serial, week, year, moduletype, capacity, ranks, width, density, dies, crc' \
+    ' FROM images'
+    if len(clauses) != 0:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY partnumber, path'
+    count = 0
+    for row in conn.execute(sql, params):
+        path, manuf, pn, sn, week, year, mtype, capacity, ranks, width, density, dies, crc = row
+        print('{}\n  {} {} S/N {} ({}/{}), {} GB {} {}Rx{} {}Gb{}, {}'.format(path, manuf, pn, sn, week, 2000 + year
+        , capacity, mtype, ranks, width, density, ' {}H'.format(dies) if dies != 1 else '', crc))
+        count += 1
+    print('{} donor dump(s) found.'.format(count))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
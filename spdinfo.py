@@ -2,12 +2,26 @@
 
 import os
 import sys
+import json
+import mmap
 import getopt
+import binascii
 import datetime
+from pathlib import Path
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import readspdfile, printerr, SPD_DDR5_EEPROM_SIZE, EEPROM_DUMP_FILE_EXT
 
 SPD_DDR5_TYPE = 0x12
 SPD_DDR_TYPE_OFFSET = 2
 
+SPD_MODULE_TYPE_OFFSET = 3
+SPD_DENSITY_PACKAGE_OFFSET = 4
+SPD_IO_WIDTH_OFFSET = 6
+SPD_MODULE_ORG_OFFSET = 234
+SPD_BUS_WIDTH_OFFSET = 235
+
 SPD_MANUF_ID_OFFSET = 512
 SPD_MANUF_ID_LENGTH = 2
 SPD_MANUF_DATE_OFFSET = 515
@@ -27,49 +41,71 @@ SPD_EXPO_OFFSET = 832
 SPD_EXPO_SECTION_LENGTH = 128
 
 def usage():
-    printerr(sys.argv[0], '--file <dump> --fixcrc --help')
+    printerr(sys.argv[0], '--file <dump> --fixcrc --batch <dir> --corpus <dir> --format <jsonl|csv> --help')
     sys.exit(1)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'f:h', ['file=', 'fixcrc', 'help'])
+        opts, args = getopt.getopt(argv, 'f:h', ['file=', 'fixcrc', 'batch=', 'corpus=', 'format=', 'help'])
     except getopt.GetoptError:
         usage()
 
     dump = ''
     fixcrc = False
+    batch = ''
+    corpus = ''
+    fmt = 'jsonl'
     for opt, arg in opts:
         if opt in ('-h', '--help'):
-            print(sys.argv[0], '--file <dump> --fixcrc')
+            print(sys.argv[0], '--file <dump> --fixcrc --batch <dir> --corpus <dir> --format <jsonl|csv>')
             print('  -f --file: SPD dump in raw binary format.')
             print('  --fixcrc: calculate new CRC checksum(s).')
             print('    (Will write fixed SPD dump to `stdout`.)')
+            print('  --batch: verify CRCs of all `.spd` files in the directory tree.')
+            print('    (One line per file: path, then base, XMP #1..5 and EXPO status:')
+            print('    `pass`, `fail` or `none` if the section is not present.)')
+            print('  --corpus: decode all `.spd` files in the directory tree.')
+            print('    (Manufacturer, date, S/N, P/N and all section CRCs, one record per file.)')
+            print('  --format: output format for --corpus (jsonl)')
             sys.exit(0)
         elif opt in ('-f', '--file'):
             dump = arg
         elif opt in ('--fixcrc'):
             fixcrc = True
-    if dump == '':
+        elif opt in ('--batch'):
+            batch = arg
+        elif opt in ('--corpus'):
+            corpus = arg
+        elif opt in ('--format'):
+            fmt = arg
+    if [dump, batch, corpus].count('') != 2 \
+    or dump == '' and fixcrc \
+    or fmt not in ('jsonl', 'csv'):
         usage()
 
-    analyzespd(dump, fixcrc)
+    if batch != '':
+        batchcrc(batch)
+    elif corpus != '':
+        analyzecorpus(corpus, fmt)
+    else:
+        analyzespd(dump, fixcrc)
 
 def analyzespd(filepath, fixcrc):
-    spddata = readspdfile(filepath)
+    image = SpdImage.fromfile(filepath)
 
-    ddrv = spddata[SPD_DDR_TYPE_OFFSET]
-    if ddrv != SPD_DDR5_TYPE:
+    if not image.isddr5():
         printerr("SPD dump doesn't appear to be from DDR5 memory.")
         sys.exit(1)
 
     if not fixcrc:
+        ident = image.identity
+
         # Manufacturer
-        mid = spddata[SPD_MANUF_ID_OFFSET:SPD_MANUF_ID_OFFSET + SPD_MANUF_ID_LENGTH]
-        print('Manufacturer: {}'.format(mid.hex()))
+        print('Manufacturer: {}'.format(ident['manufacturer']))
 
         # Date of production
-        myear = bcd(spddata[SPD_MANUF_DATE_OFFSET])
-        mweek = bcd(spddata[SPD_MANUF_DATE_OFFSET + 1])
+        myear = ident['year']
+        mweek = ident['week']
         if mweek < 1 or mweek > 52:
             mdate = '?'
         else:
@@ -78,51 +114,311 @@ def analyzespd(filepath, fixcrc):
         print('Produced: {}/{} ({})'.format(mweek, 2000 + myear, mdate))
 
         # Serial and part numbers
-        sn = spddata[SPD_SN_OFFSET:SPD_SN_OFFSET + SPD_SN_LENGTH]
-        print('S/N: {}'.format(sn.hex()))
-        pn = spddata[SPD_PN_OFFSET:SPD_PN_OFFSET + SPD_PN_LENGTH]
-        print('P/N: {}'.format(pn.decode().strip()))
+        print('S/N: {}'.format(ident['serial']))
+        print('P/N: {}'.format(ident['partnumber']))
 
     # Calculate CRC checksums
-    start = 0
-    end = SPD_MANUF_ID_OFFSET
-    crc = calccrc(spddata, start, end)
     crcfail = False
     if fixcrc:
-        putcrc(spddata, start, end - start, crc)
+        image.fixcrc()
     else:
-        crcdump = getcrc(spddata, start, end - start)
-        crcfail = crcfail or crcdump != crc
-        print('Main CRC: {} ({})'.format(hex(crcdump), hex(crc)))
-    if xmppresent(spddata):
-        for n in range(1, 6):
-            if xmpprofilepresent(spddata, n):
-                start = SPD_XMP30_OFFSET + n * SPD_XMP30_PROFILE_LENGTH
-                end = start + SPD_XMP30_PROFILE_LENGTH
-                crc = calccrc(spddata, start, end)
-                if fixcrc:
-                    putcrc(spddata, start, end - start, crc)
-                else:
-                    crcdump = getcrc(spddata, start, end - start)
-                    crcfail = crcfail or crcdump != crc
-                    print('  XMP profile #{} CRC: {} ({})'.format(n, hex(crcdump), hex(crc)))
-    if expopresent(spddata):
-        start = SPD_EXPO_OFFSET
-        end = start + SPD_EXPO_SECTION_LENGTH
-        crc = calccrc(spddata, start, end)
-        if fixcrc:
-            putcrc(spddata, start, end - start, crc)
-        else:
-            crcdump = getcrc(spddata, start, end - start)
+        for section in image.sections:
+            crcdump = section.storedcrc()
+            crc = section.computedcrc()
             crcfail = crcfail or crcdump != crc
-            print('  EXPO CRC: {} ({})'.format(hex(crcdump), hex(crc)))
+            print('{}: {} ({})'.format(SPD_CRC_SECTION_LABELS[section.name], hex(crcdump), hex(crc)))
 
     # Write SPD with fixed CRCs to stdout
     if fixcrc:
-        sys.stdout.buffer.write(spddata)
+        sys.stdout.buffer.write(image.data)
     elif crcfail:
         printerr('\nWARNING: CRC mismatch!')
 
+class SpdSection:
+    # CRC protected section: a view into the image bytes
+    __slots__ = ('name', 'start', 'end', 'view')
+
+    def __init__(self, image, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.view = image.view[start:end]
+
+    def storedcrc(self):
+        return getcrc(self.view, 0, len(self.view))
+
+    def computedcrc(self):
+        return calccrc(self.view, 0, len(self.view))
+
+    def valid(self):
+        return self.storedcrc() == self.computedcrc()
+
+    def fixcrc(self):
+        putcrc(self.view, 0, len(self.view), self.computedcrc())
+
+class SpdImage:
+    # SPD EEPROM image shared by the analyzers and the tools
+    # working with the hardware. Sections are exposed as views
+    # into the same buffer (no copies are made) and decoded
+    # fields are cached on first access. Modifications must
+    # go through `write()` to keep the caches consistent.
+    __slots__ = ('data', 'view', 'cachedidentity', 'cachedgeometry', 'cachedsections')
+
+    def __init__(self, data):
+        if isinstance(data, bytes):
+            data = bytearray(data) # CRCs can be fixed in place
+        self.data = data
+        self.view = memoryview(data)
+        self.invalidate()
+
+    @classmethod
+    def fromfile(cls, filepath):
+        return cls(readspdfile(filepath))
+
+    def invalidate(self):
+        self.cachedidentity = None
+        self.cachedgeometry = None
+        self.cachedsections = None
+
+    def release(self):
+        # Needed before closing an underlying `mmap`
+        if self.cachedsections is not None:
+            for section in self.cachedsections:
+                section.view.release()
+        self.invalidate()
+        self.view.release()
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, key):
+        return self.view[key]
+
+    def write(self, offset, data):
+        self.view[offset:offset + len(data)] = bytes(data)
+        self.invalidate()
+
+    def isddr5(self):
+        return len(self.view) == SPD_DDR5_EEPROM_SIZE \
+        and self.view[SPD_DDR_TYPE_OFFSET] == SPD_DDR5_TYPE
+
+    @property
+    def base(self):
+        return self.view[0:SPD_MANUF_ID_OFFSET]
+
+    @property
+    def manufacturing(self):
+        return self.view[SPD_MANUF_ID_OFFSET:SPD_XMP30_OFFSET]
+
+    @property
+    def xmpheader(self):
+        return self.view[SPD_XMP30_OFFSET:SPD_XMP30_OFFSET + SPD_XMP30_HEADER_LENGTH]
+
+    def xmpprofile(self, num):
+        start = SPD_XMP30_OFFSET + num * SPD_XMP30_PROFILE_LENGTH
+        return self.view[start:start + SPD_XMP30_PROFILE_LENGTH]
+
+    @property
+    def expo(self):
+        return self.view[SPD_EXPO_OFFSET:SPD_EXPO_OFFSET + SPD_EXPO_SECTION_LENGTH]
+
+    @property
+    def identity(self):
+        if self.cachedidentity is None:
+            self.cachedidentity = decodeidentity(self.view)
+        return self.cachedidentity
+
+    @property
+    def geometry(self):
+        if self.cachedgeometry is None:
+            self.cachedgeometry = decodegeometry(self.view)
+        return self.cachedgeometry
+
+    @property
+    def sections(self):
+        if self.cachedsections is None:
+            self.cachedsections = [SpdSection(self, name, start, end)
+            for name, start, end in crcsections(self.view)]
+        return self.cachedsections
+
+    def section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def crcstatus(self):
+        # {section: 'pass' | 'fail' | 'none'} for every known section
+        status = dict.fromkeys(SPD_CRC_SECTIONS, 'none')
+        for section in self.sections:
+            status[section.name] = 'pass' if section.valid() else 'fail'
+        return status
+
+    def fixcrc(self):
+        for section in self.sections:
+            section.fixcrc()
+
+def decodeidentity(data):
+    return {
+        'manufacturer': bytes(data[SPD_MANUF_ID_OFFSET:SPD_MANUF_ID_OFFSET + SPD_MANUF_ID_LENGTH]).hex(),
+        'year': bcd(data[SPD_MANUF_DATE_OFFSET]),
+        'week': bcd(data[SPD_MANUF_DATE_OFFSET + 1]),
+        'serial': bytes(data[SPD_SN_OFFSET:SPD_SN_OFFSET + SPD_SN_LENGTH]).hex(),
+        'partnumber': bytes(data[SPD_PN_OFFSET:SPD_PN_OFFSET + SPD_PN_LENGTH]).decode(errors='replace').strip()
+    }
+
+SPD_MODULE_TYPES = {
+    0x1: 'RDIMM', 0x2: 'UDIMM', 0x3: 'SODIMM', 0x4: 'LRDIMM', 0x5: 'CUDIMM',
+    0x6: 'CSODIMM', 0x7: 'MRDIMM', 0x8: 'CAMM2', 0xa: 'DDIMM', 0xb: 'Solder down'
+}
+SPD_DIE_DENSITIES = {0x1: 4, 0x2: 8, 0x3: 12, 0x4: 16, 0x5: 24, 0x6: 32, 0x7: 48, 0x8: 64} # Gbit
+SPD_PACKAGE_DIES = {0x0: 1, 0x2: 2, 0x3: 4, 0x4: 8, 0x5: 16}
+SPD_IO_WIDTHS = {0x0: 4, 0x1: 8, 0x2: 16, 0x3: 32}
+SPD_BUS_WIDTHS = {0x0: 8, 0x1: 16, 0x2: 32, 0x3: 64}
+
+def decodegeometry(data):
+    # Module organization from the base section,
+    # fields which can't be decoded are `None`
+    density = SPD_DIE_DENSITIES.get(data[SPD_DENSITY_PACKAGE_OFFSET] & 0x1f)
+    dies = SPD_PACKAGE_DIES.get(data[SPD_DENSITY_PACKAGE_OFFSET] >> 5)
+    width = SPD_IO_WIDTHS.get(data[SPD_IO_WIDTH_OFFSET] >> 5)
+    ranks = ((data[SPD_MODULE_ORG_OFFSET] >> 3) & 7) + 1
+    buswidth = SPD_BUS_WIDTHS.get(data[SPD_BUS_WIDTH_OFFSET] & 7)
+    subchannels = ((data[SPD_BUS_WIDTH_OFFSET] >> 5) & 3) + 1
+    capacity = None
+    if None not in (density, dies, width, buswidth):
+        capacity = subchannels * buswidth // width * dies * density * ranks // 8 # GB
+    return {
+        'moduletype': SPD_MODULE_TYPES.get(data[SPD_MODULE_TYPE_OFFSET] & 0xf),
+        'density': density,
+        'dies': dies,
+        'width': width,
+        'ranks': ranks,
+        'capacity': capacity
+    }
+
+SPD_CRC_SECTIONS = ['base', 'xmp1', 'xmp2', 'xmp3', 'xmp4', 'xmp5', 'expo']
+SPD_CRC_SECTION_LABELS = {
+    'base': 'Main CRC',
+    'xmp1': '  XMP profile #1 CRC',
+    'xmp2': '  XMP profile #2 CRC',
+    'xmp3': '  XMP profile #3 CRC',
+    'xmp4': '  XMP profile #4 CRC',
+    'xmp5': '  XMP profile #5 CRC',
+    'expo': '  EXPO CRC'
+}
+
+def crcsections(data):
+    # All CRC protected sections present in the image:
+    # [(name, start, end), ...], CRC is in the last two bytes
+    sections = [('base', 0, SPD_MANUF_ID_OFFSET)]
+    if xmppresent(data):
+        for n in range(1, 6):
+            if xmpprofilepresent(data, n):
+                start = SPD_XMP30_OFFSET + n * SPD_XMP30_PROFILE_LENGTH
+                sections.append(('xmp{}'.format(n), start, start + SPD_XMP30_PROFILE_LENGTH))
+    if expopresent(data):
+        sections.append(('expo', SPD_EXPO_OFFSET, SPD_EXPO_OFFSET + SPD_EXPO_SECTION_LENGTH))
+    return sections
+
+SPD_CORPUS_FIELDS = ['path', 'error', 'manufacturer', 'year', 'week', 'serial', 'partnumber']
+for name in SPD_CRC_SECTIONS:
+    SPD_CORPUS_FIELDS += [name, name + '_stored', name + '_computed']
+
+SPD_CORPUS_WINDOW = 4096 # files in flight at once
+
+def corpusfiles(dirpath):
+    # Lazily walk the tree: never holds the whole file list
+    for root, dirs, files in os.walk(dirpath):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('.' + EEPROM_DUMP_FILE_EXT):
+                yield os.path.join(root, name)
+
+def corpusrecord(filepath):
+    record = dict.fromkeys(SPD_CORPUS_FIELDS)
+    record['path'] = str(filepath)
+    try:
+        file = open(filepath, 'rb')
+    except OSError:
+        record['error'] = 'io'
+        return record
+    try:
+        if os.fstat(file.fileno()).st_size != SPD_DDR5_EEPROM_SIZE:
+            record['error'] = 'size'
+            return record
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        image = SpdImage(data)
+        if not image.isddr5():
+            record['error'] = 'type'
+        else:
+            record.update(image.identity)
+            for name in SPD_CRC_SECTIONS:
+                record[name] = 'none'
+            for section in image.sections:
+                stored = section.storedcrc()
+                computed = section.computedcrc()
+                record[section.name] = 'pass' if stored == computed else 'fail'
+                record[section.name + '_stored'] = '{:04x}'.format(stored)
+                record[section.name + '_computed'] = '{:04x}'.format(computed)
+        image.release()
+        data.close()
+    except (OSError, ValueError):
+        record['error'] = 'io'
+    finally:
+        file.close()
+    return record
+
+def corpusrecords(paths, workers=None):
+    # Decoded record for every file in `paths` (a directory
+    # or any iterable of files), in order. Files are handed
+    # to a process pool a window at a time to keep memory
+    # use constant regardless of the corpus size.
+    if isinstance(paths, (str, Path)):
+        paths = corpusfiles(paths)
+    # Only imported when needed, for a fast start with single dumps
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = []
+        for filepath in paths:
+            window.append(filepath)
+            if len(window) == SPD_CORPUS_WINDOW:
+                yield from pool.map(corpusrecord, window, chunksize=64)
+                window = []
+        yield from pool.map(corpusrecord, window, chunksize=64)
+
+def analyzecorpus(dirpath, fmt):
+    if not Path(dirpath).is_dir():
+        printerr('Directory not found: "{}".'.format(dirpath))
+        sys.exit(1)
+    if fmt == 'csv':
+        import csv
+        writer = csv.DictWriter(sys.stdout, SPD_CORPUS_FIELDS)
+        writer.writeheader()
+    for record in corpusrecords(dirpath):
+        if fmt == 'csv':
+            writer.writerow(record)
+        else:
+            print(json.dumps(record))
+
+def batchcrc(dirpath):
+    if not Path(dirpath).is_dir():
+        printerr('Directory not found: "{}".'.format(dirpath))
+        sys.exit(1)
+    total = 0
+    failed = 0
+    for record in corpusrecords(dirpath):
+        total += 1
+        if record['error'] is not None:
+            print('{}\terror={}'.format(record['path'], record['error']))
+            failed += 1
+            continue
+        print('\t'.join([record['path']] + ['{}={}'.format(name, record[name]) for name in SPD_CRC_SECTIONS]))
+        failed += 'fail' in [record[name] for name in SPD_CRC_SECTIONS]
+    if failed != 0:
+        printerr('\nWARNING: {} of {} file(s) failed verification!'.format(failed, total))
+        sys.exit(1)
+
 def xmppresent(data):
     off = SPD_XMP30_OFFSET
     return data[off] == 0xc and data[off + 1] == 0x4a
@@ -144,27 +440,14 @@ def putcrc(data, blockoff, blocklen, crc):
     data[blockoff + blocklen - 1] = crc >> 8
 
 def calccrc(data, start, end):
-    crc = 0
+    # JEDEC SPD CRC is CRC-16/XMODEM (polynomial 0x1021),
+    # which is exactly what `binascii.crc_hqx()` computes.
     # Exclude last 2 bytes: do not include CRC itself
     # in new CRC computation
-    for i in range(start, end - 2):
-        crc = crc16(crc, data[i])
-    return crc
-
-SPD_CRC_POLY = 0x1021
-
-def crc16(crc, byte):
-    crc ^= byte << 8
-    for i in range(0, 8):
-        crc = (crc << 1) ^ (SPD_CRC_POLY if crc >> 15 else 0)
-        crc &= 0xffff
-    return crc
+    return binascii.crc_hqx(data[start:end - 2], 0)
 
 def bcd(byte):
     return (byte >> 4) * 10 + (byte & 0xf)
 
 if __name__ == '__main__':
-    if __package__ == None:
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from spdcommon import readspdfile, printerr
     main(sys.argv[1:])
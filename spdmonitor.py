@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import getopt
+import datetime
+from time import sleep, monotonic
+from pathlib import Path
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, optbackend, checkroot, checkddr5, setbackend, readspdfile, writespdfile \
+, detectspd, SpdDevice, printerr, EEPROM_DUMP_FILE_EXT, SPD_DDR5_EEPROM_SIZE
+from spdinfo import SpdImage, SPD_SN_OFFSET, SPD_SN_LENGTH, SPD_PN_OFFSET, SPD_PN_LENGTH
+from spdread import dumpspd
+from spdplan import rangestring
+
+SPD_MONITOR_DIR = './spdmonitor'
+SPD_MONITOR_INTERVAL = 60 # seconds
+SPD_MONITOR_BUDGET = 128 # EEPROM bytes read per module and cycle
+
+def usage():
+    printerr(sys.argv[0], '--bus <busnum>[,...] --interval <s> --budget <bytes> --dir <dir> --events <file>'
+    , '--once --yes --block --backend <auto|i2cdev|i2ctools> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'b:h', ['bus=', 'interval=', 'budget=', 'dir=', 'events=', 'once', 'yes'
+        , 'block', 'backend=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    buses = []
+    interval = SPD_MONITOR_INTERVAL
+    budget = SPD_MONITOR_BUDGET
+    dirpath = SPD_MONITOR_DIR
+    events = ''
+    once = False
+    yes = False
+    block = False
+    backend = 'auto'
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--bus <busnum>[,...] --interval <s> --budget <bytes> --dir <dir> --events <file>'
+                , '--once --yes --block --backend <auto|i2cdev|i2ctools>')
+                print('  -b --bus: SMBus adapter(s) to watch (all of them)')
+                print('  --interval: seconds between checks ({})'.format(SPD_MONITOR_INTERVAL))
+                print('  --budget: EEPROM bytes read per module and check ({})'.format(SPD_MONITOR_BUDGET))
+                print('    (Serial number and CRC bytes are always read, the rest of the budget')
+                print('    goes to a window moving over the whole EEPROM from check to check.)')
+                print('  --dir: where baseline images are kept ({})'.format(SPD_MONITOR_DIR))
+                print('  --events: append events to this file as JSON Lines.')
+                print('  --once: check once and exit (e.g. from cron).')
+                print('  --yes: do not ask for confirmation (e.g. when run as a service).')
+                print('  --block: read in I2C blocks instead of byte-by-byte.')
+                print('  --backend: SMBus access method (auto)')
+                print('')
+                print('The whole EEPROM is only read again when sampled bytes change.')
+                print('A module whose part number changed along with its serial number is taken')
+                print('as swapped and gets a new baseline, a serial number change alone is drift.')
+                sys.exit(0)
+            elif opt in ('-b', '--bus'):
+                buses = [optint(bus) for bus in arg.split(',')]
+            elif opt in ('--interval'):
+                interval = optint(arg)
+            elif opt in ('--budget'):
+                budget = optint(arg)
+            elif opt in ('--dir'):
+                dirpath = arg
+            elif opt in ('--events'):
+                events = arg
+            elif opt in ('--once'):
+                once = True
+            elif opt in ('--yes'):
+                yes = True
+            elif opt in ('--block'):
+                block = True
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
+        except:
+            usage()
+    if interval <= 0 or budget < 0:
+        usage()
+
+    setbackend(backend)
+    checkroot()
+    checkddr5()
+    monitorspd(buses, interval, budget, dirpath, events, once, yes, block)
+
+class SpdMonitorState:
+    # What is known about a single module between checks
+    def __init__(self, busnum, dimmaddr):
+        self.busnum = busnum
+        self.dimmaddr = dimmaddr
+        self.serial = None
+        self.baseline = None
+        self.cursor = 0
+
+def monitorspd(buses, interval, budget, dirpath, events, once, yes, block):
+    states = [SpdMonitorState(busnum, dimmaddr) for busnum, dimmaddr in detectspd(buses)]
+    try:
+        Path(dirpath).mkdir(parents=True, exist_ok=True)
+    except OSError:
+        printerr('Could not create directory "{}".'.format(dirpath))
+        sys.exit(1)
+
+    print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.')
+    print('Checking involves switching EEPROM pages: software accessing SMBus at the same time')
+    print('may end up writing to the wrong place. Do not run it alongside such software.\n')
+    print('Will now watch {} DIMM(s) every {} s, reading up to {} byte(s) each time:'.format(len(states), interval
+    , budget + SPD_SN_LENGTH))
+    for state in states:
+        print('  /dev/i2c-{}, chip address {}'.format(state.busnum, hex(state.dimmaddr)))
+    print('')
+    if not yes:
+        go = input('Continue? (yes/no): ').lower()
+        print('')
+        if go not in ['yes']:
+            print('Exiting without performing any operations on SMBus.')
+            sys.exit(0)
+
+    try:
+        while True:
+            start = monotonic()
+            for state in states:
+                try:
+                    monitorcheck(state, budget, dirpath, events, block)
+                except SystemExit:
+                    # Already reported, try again next time
+                    monitorevent(events, 'error', state)
+            if once:
+                break
+            sleep(max(0, interval - (monotonic() - start)))
+    except KeyboardInterrupt:
+        print('')
+
+def monitorevent(events, kind, state, **fields):
+    event = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'event': kind,
+        'bus': state.busnum,
+        'dimm': hex(state.dimmaddr),
+        'serial': state.serial
+    }
+    event.update(fields)
+    print('{} bus {} DIMM {} S/N {}: {}{}'.format(event['time'], state.busnum, hex(state.dimmaddr), state.serial, kind
+    , ''.join(' {}={}'.format(key, value) for key, value in fields.items())), flush=True)
+    if events != '':
+        try:
+            with open(events, 'a') as file:
+                file.write(json.dumps(event) + '\n')
+        except OSError:
+            printerr('Could not write to events file "{}".'.format(events))
+
+def baselinepath(dirpath, state):
+    return Path(dirpath) / 'bus{}-{}-{}.{}'.format(state.busnum, hex(state.dimmaddr), state.serial, EEPROM_DUMP_FILE_EXT)
+
+def cursorpath(path):
+    return path.with_suffix('.json')
+
+def loadcursor(path):
+    try:
+        cursor = json.loads(cursorpath(path).read_text())['cursor']
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+    return cursor % SPD_DDR5_EEPROM_SIZE if isinstance(cursor, int) else 0
+
+def savecursor(dirpath, state):
+    try:
+        cursorpath(baselinepath(dirpath, state)).write_text(json.dumps({'cursor': state.cursor}))
+    except OSError:
+        printerr('Could not save window position next to the baseline.')
+
+def partnumberbaseline(dirpath, state, partnumber):
+    # Baseline of a module in the same slot with the same part number:
+    # the same module with its serial number corrupted, most likely
+    found = None
+    for path in Path(dirpath).glob('bus{}-{}-*.{}'.format(state.busnum, hex(state.dimmaddr), EEPROM_DUMP_FILE_EXT)):
+        # Drifted images kept as evidence have a timestamp appended
+        if len(path.stem.split('-')) != 3 or path.stat().st_size != SPD_DDR5_EEPROM_SIZE:
+            continue
+        if readspdfile(str(path))[SPD_PN_OFFSET:SPD_PN_OFFSET + SPD_PN_LENGTH] == partnumber \
+        and (found is None or path.stat().st_mtime > found.stat().st_mtime):
+            found = path
+    return found
+
+def loadbaseline(state, dev, serial, dirpath, events, block):
+    # Returns whether the module still has to be compared with the
+    # baseline (false when a new baseline has just been read)
+    state.serial = serial
+    path = baselinepath(dirpath, state)
+    if not path.exists():
+        path = partnumberbaseline(dirpath, state, bytes(dev.read(SPD_PN_OFFSET, SPD_PN_LENGTH, block)))
+    if path is None:
+        state.cursor = 0
+        state.baseline = SpdImage(dumpspd(dev, block, False))
+        path = baselinepath(dirpath, state)
+        writespdfile(str(path), state.baseline.data)
+        savecursor(dirpath, state)
+        monitorevent(events, 'baseline', state, baseline=str(path), crc=crcsummary(state.baseline))
+        return False
+    state.serial = path.stem.split('-')[2]
+    # Changes already reported by an earlier run are not reported again
+    drifted = sorted(path.parent.glob('{}-*{}'.format(path.stem, path.suffix)))
+    reference = drifted[-1] if len(drifted) != 0 else path
+    state.baseline = SpdImage(readspdfile(str(reference)))
+    state.cursor = loadcursor(path)
+    monitorevent(events, 'resumed', state, baseline=str(path), reference=str(reference))
+    return True
+
+def sampleoffsets(state, budget):
+    # Bytes to look at this time: stored CRCs of all sections (which
+    # change when software rewrites a section properly) plus the next
+    # window of the EEPROM (which catches stray writes sooner or later)
+    offsets = set()
+    for section in state.baseline.sections:
+        offsets.update((section.end - 2, section.end - 1))
+    window = max(0, budget - len(offsets))
+    for n in range(0, window):
+        offsets.add((state.cursor + n) % SPD_DDR5_EEPROM_SIZE)
+    state.cursor = (state.cursor + window) % SPD_DDR5_EEPROM_SIZE
+    return sorted(offsets)
+
+def readoffsets(dev, offsets, block):
+    # Contiguous offsets are read together
+    data = {}
+    rngs = [[idx, idx] for idx in offsets[:1]]
+    for idx in offsets[1:]:
+        if idx == rngs[-1][1] + 1:
+            rngs[-1][1] = idx
+        else:
+            rngs.append([idx, idx])
+    for rng in rngs:
+        for idx, byte in enumerate(dev.read(rng[0], rng[1] - rng[0] + 1, block), rng[0]):
+            data[idx] = byte
+    return data
+
+def monitorcheck(state, budget, dirpath, events, block):
+    with SpdDevice(state.busnum, state.dimmaddr) as dev:
+        serial = bytes(dev.read(SPD_SN_OFFSET, SPD_SN_LENGTH, block)).hex()
+        if state.baseline is not None and serial != state.baseline.identity['serial'] \
+        and bytes(dev.read(SPD_PN_OFFSET, SPD_PN_LENGTH, block)) \
+        != bytes(state.baseline[SPD_PN_OFFSET:SPD_PN_OFFSET + SPD_PN_LENGTH]):
+            # Part number changed too: the module has been swapped
+            monitorevent(events, 'swapped', state, newserial=serial)
+            state.baseline = None
+        if state.baseline is None:
+            # First check, or another module
+            if not loadbaseline(state, dev, serial, dirpath, events, block):
+                return
+
+        # A serial number differing from the baseline with the same
+        # part number is drift in the serial number itself
+        if serial == state.baseline.identity['serial']:
+            samples = readoffsets(dev, sampleoffsets(state, budget), block)
+            savecursor(dirpath, state)
+            if all(state.baseline[idx] == byte for idx, byte in samples.items()):
+                return
+        current = SpdImage(dumpspd(dev, block, False))
+
+    changed = [idx for idx in range(0, SPD_DDR5_EEPROM_SIZE) if current[idx] != state.baseline[idx]]
+    if len(changed) == 0:
+        # Sampled bytes differed, but the EEPROM didn't change
+        monitorevent(events, 'glitch', state)
+        return
+    # The baseline on disk stays the first image ever seen (to repair
+    # the module from), the new contents are kept next to it as evidence
+    path = baselinepath(dirpath, state)
+    drifted = path.with_name('{}-{}{}'.format(path.stem, datetime.datetime.now().strftime('%Y%m%d%H%M%S'), path.suffix))
+    writespdfile(str(drifted), current.data)
+    monitorevent(events, 'drift', state, count=len(changed), offsets=rangestring(changed)
+    , crc=crcsummary(current), image=str(drifted))
+    state.baseline = current
+
+def crcsummary(image):
+    return ','.join('{}:{}'.format(name, status) for name, status in image.crcstatus().items() if status != 'none')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, checkroot, checkddr5, setbackend, writeestimate, writespdfile \
+, rswpblocksget, SpdDevice, printerr, SPD_DDR5_EEPROM_SIZE, SPD_DDR5_EEPROM_PAGE_SIZE, SPD_DDR5_EEPROM_BLOCK_SIZE
+from spdinfo import SpdImage, xmppresent, SPD_CRC_SECTION_LABELS, SPD_MANUF_ID_OFFSET, SPD_MANUF_DATE_OFFSET, SPD_SN_OFFSET, SPD_SN_LENGTH \
+, SPD_XMP30_OFFSET, SPD_XMP30_HEADER_LENGTH
+from spdread import dumpspd
+
+SPD_PLAN_FILE = './plan.spd'
+
+# Bytes which are unique to every module: never taken from the donor
+SPD_PLAN_KEEP = range(SPD_MANUF_DATE_OFFSET, SPD_SN_OFFSET + SPD_SN_LENGTH)
+
+def usage():
+    printerr(sys.argv[0], '--donor <dump> --current <dump> | --bus <busnum> --dimm <dimmaddr> [--block]'
+    , '--out <file> --locate --backend <auto|i2cdev|i2ctools> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'b:d:o:h', ['donor=', 'current=', 'bus=', 'dimm=', 'block', 'out='
+        , 'locate', 'backend=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    donor = ''
+    current = ''
+    bus = -1
+    dimm = -1
+    block = False
+    out = SPD_PLAN_FILE
+    locate = False
+    backend = 'auto'
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--donor <dump> --current <dump> | --bus <busnum> --dimm <dimmaddr> [--block]'
+                , '--out <file> --locate --backend <auto|i2cdev|i2ctools>')
+                print('  --donor: clean SPD dump of the same module model.')
+                print('  --current: damaged SPD dump read from the module earlier.')
+                print('  -b --bus: bus number to read the module from (0)')
+                print('  -d --dimm: dimm address on the bus (0x51)')
+                print('    (Write protection is taken into account only if the module can be accessed.)')
+                print('  --block: read in I2C blocks instead of byte-by-byte.')
+                print('  -o --out: where to save the repaired image for `spdwrite.py` ({})'.format(SPD_PLAN_FILE))
+                print('  --locate: only show where the damage is and the `--range` covering it.')
+                print('    (The donor serves as the reference image.)')
+                print('  --backend: SMBus access method (auto)')
+                print('')
+                print('Only sections failing CRC checks are taken from the donor,')
+                print('the module\'s own production date and serial number are always kept.')
+                sys.exit(0)
+            elif opt in ('-b', '--bus'):
+                bus = optint(arg)
+            elif opt in ('-d', '--dimm'):
+                dimm = opthex(arg)
+            elif opt in ('-o', '--out'):
+                out = arg
+            elif opt in ('--donor'):
+                donor = arg
+            elif opt in ('--current'):
+                current = arg
+            elif opt in ('--block'):
+                block = True
+            elif opt in ('--locate'):
+                locate = True
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
+        except:
+            usage()
+    live = bus != -1 or dimm != -1
+    if donor == '' \
+    or not live and current == '' \
+    or live and (bus < 0 or bus > 99 or dimm < 0x50 or dimm > 0x57):
+        usage()
+
+    donorimage = loadimage(donor)
+    currentimage = None
+    if current != '':
+        currentimage = loadimage(current)
+    rswpblocks = [False] * (SPD_DDR5_EEPROM_SIZE // SPD_DDR5_EEPROM_BLOCK_SIZE)
+    if live:
+        setbackend(backend)
+        checkroot()
+        checkddr5()
+        currentimage, rswpblocks = readmodule(bus, dimm, block, currentimage)
+    elif not locate:
+        print('NOTE: module is not accessed, write protection is not known.\n')
+
+    if locate:
+        reportdamage(currentimage, *locatedamage(currentimage, donorimage))
+        return
+
+    target, writes, blocked = planpatch(currentimage, donorimage, rswpblocks)
+    reportpatch(currentimage, donorimage, target, writes, blocked)
+    if len(writes) != 0:
+        writespdfile(out, target.data)
+        print('')
+        print('Repaired image written to: "{}". To apply it:'.format(out))
+        print('  {} --bus {} --dimm {} --file {} --range {}'.format(os.path.join(os.path.dirname(sys.argv[0]), 'spdwrite.py')
+        , bus if live else '<busnum>', hex(dimm) if live else '<dimmaddr>', out, rangestring(writes)))
+    if len(blocked) != 0:
+        sys.exit(1)
+
+def loadimage(filepath):
+    image = SpdImage.fromfile(filepath)
+    if not image.isddr5():
+        printerr('"{}" doesn\'t appear to be from DDR5 memory.'.format(filepath))
+        sys.exit(1)
+    return image
+
+def readmodule(busnum, dimmaddr, block, image):
+    # Current contents (unless already given) and write protection
+    print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
+    print('Will now read from device file /dev/i2c-{}, chip address {}.\n'.format(busnum, hex(dimmaddr)))
+
+    go = input('Continue? (yes/no): ').lower()
+    print('')
+    if go not in ['yes']:
+        print('Exiting without performing any operations on SMBus.')
+        sys.exit(0)
+    with SpdDevice(busnum, dimmaddr) as dev:
+        rswpblocks = rswpblocksget(dev)
+        if image is None:
+            print('Reading SPD EEPROM...')
+            image = SpdImage(dumpspd(dev, block, False))
+    print('')
+    if not image.isddr5():
+        printerr('Module doesn\'t appear to be DDR5 memory.')
+        sys.exit(1)
+    return image, rswpblocks
+
+def planpatch(current, donor, rswpblocks):
+    # Smallest set of byte writes making every section pass its CRC check:
+    # sections which already do are left alone, the rest are taken from
+    # the donor. Returns the image after the writes, the writes themselves
+    # and bytes which should be written but are write-protected.
+    regions = []
+    for section in donor.sections:
+        own = current.section(section.name)
+        if own is None or not own.valid():
+            regions.append((section.name, section.start, section.end))
+    if xmppresent(donor) and not xmppresent(current):
+        # Profiles can't even be found without a valid header
+        regions.append(('xmp', SPD_XMP30_OFFSET, SPD_XMP30_OFFSET + SPD_XMP30_HEADER_LENGTH))
+
+    target = SpdImage(bytes(current.view))
+    writes = set()
+    blocked = {}
+    for name, start, end in regions:
+        for idx in range(start, end):
+            if idx in SPD_PLAN_KEEP or current[idx] == donor[idx]:
+                continue
+            if rswpblocks[idx // SPD_DDR5_EEPROM_BLOCK_SIZE]:
+                blocked.setdefault(name, []).append(idx)
+                continue
+            writes.add(idx)
+    for idx in writes:
+        target.write(idx, [donor[idx]])
+    return target, sorted(writes), blocked
+
+def reportpatch(current, donor, target, writes, blocked):
+    before = current.crcstatus()
+    after = target.crcstatus()
+    for section in target.sections:
+        print('{}: {} -> {}'.format(SPD_CRC_SECTION_LABELS[section.name].strip(), before[section.name], after[section.name]))
+    for section in target.sections:
+        if after[section.name] == 'fail' and donor.section(section.name) is None:
+            printerr('WARNING: {} fails and the donor has no data to repair it with.'
+            .format(SPD_CRC_SECTION_LABELS[section.name].strip()))
+    print('')
+
+    switches = 1 # restore of the first virtual page
+    page = -1
+    for idx in writes:
+        if idx // SPD_DDR5_EEPROM_PAGE_SIZE != page:
+            page = idx // SPD_DDR5_EEPROM_PAGE_SIZE
+            switches += 1
+    print('{} byte(s) to write on {} page(s), {} page switch(es).'.format(len(writes), switches - 1, switches))
+    print('Estimated time: at most {:.1f} seconds.'.format(writeestimate(len(writes), switches)))
+
+    if len(blocked) != 0:
+        print('')
+        for name, idxs in blocked.items():
+            blocks = sorted(set(idx // SPD_DDR5_EEPROM_BLOCK_SIZE for idx in idxs))
+            printerr('WARNING: {} damaged byte(s) in {} lie in write-protected block(s) {}!'
+            .format(len(idxs), regionlabel(name), ', '.join(str(block) for block in blocks)))
+        printerr('These bytes can\'t be repaired over SMBus, see "A Note on RSWP" in README.')
+    elif len(writes) == 0:
+        print('Nothing to repair.')
+
+SPD_JUNK_RUN = 4 # bytes
+
+def regionname(image, idx):
+    # Regions not covered by any CRC
+    if SPD_MANUF_ID_OFFSET <= idx < SPD_XMP30_OFFSET:
+        return 'manufacturing'
+    if xmppresent(image) and SPD_XMP30_OFFSET <= idx < SPD_XMP30_OFFSET + SPD_XMP30_HEADER_LENGTH:
+        return 'xmp'
+    return 'user'
+
+SPD_REGION_LABELS = {
+    'manufacturing': 'Manufacturing data (no CRC)',
+    'xmp': 'XMP header (no CRC)',
+    'user': 'End user data (no CRC)'
+}
+
+def regionlabel(name):
+    if name in SPD_CRC_SECTION_LABELS:
+        return SPD_CRC_SECTION_LABELS[name].strip().replace(' CRC', ' section')
+    return SPD_REGION_LABELS[name]
+
+def locatedamage(current, reference):
+    # Bytes differing from the reference where it matters:
+    # in sections failing CRC checks and in regions without
+    # a CRC at all. Returns {region: [offsets]} and the number
+    # of differing bytes in sections which pass.
+    status = current.crcstatus()
+    covered = {}
+    for section in reference.sections:
+        for idx in range(section.start, section.end):
+            covered[idx] = section.name
+    damage = {}
+    ignored = 0
+    for idx in range(0, SPD_DDR5_EEPROM_SIZE):
+        if idx in SPD_PLAN_KEEP or current[idx] == reference[idx]:
+            continue
+        name = covered.get(idx)
+        if name is None:
+            name = regionname(reference, idx)
+        elif status[name] == 'pass':
+            ignored += 1
+            continue
+        damage.setdefault(name, []).append(idx)
+    return damage, ignored
+
+def damagepatterns(image, idxs):
+    # Typical signatures of SPD corruption among damaged bytes
+    patterns = []
+    runs = set()
+    run = []
+    for idx in idxs + [None]:
+        if idx is not None and len(run) != 0 and idx == run[-1] + 1 and image[idx] == image[run[0]]:
+            run.append(idx)
+            continue
+        if len(run) >= SPD_JUNK_RUN:
+            patterns.append('{} run at {}'.format(hex(image[run[0]]), rangestring(run)))
+            runs.update(run)
+        run = [idx] if idx is not None and image[idx] in (0x00, 0xff) else []
+    # Same in-page offset hit on several pages: writes meant for
+    # one page landing on whichever page happened to be selected
+    pages = {}
+    for idx in idxs:
+        if idx in runs:
+            continue
+        pages.setdefault(idx % SPD_DDR5_EEPROM_PAGE_SIZE, []).append(idx)
+    aliased = sorted(idx for same in pages.values() if len(same) > 1 for idx in same)
+    if len(aliased) != 0:
+        patterns.append('same in-page offset(s) damaged on several pages at {}'.format(rangestring(aliased)))
+    # Lone bytes: stray writes by software talking some other protocol
+    isolated = [idx for idx in idxs if idx - 1 not in idxs and idx + 1 not in idxs and idx not in aliased]
+    if len(isolated) != 0:
+        patterns.append('{} isolated byte(s) at {}'.format(len(isolated), rangestring(isolated)))
+    return patterns
+
+def reportdamage(current, damage, ignored):
+    idxs = sorted(idx for region in damage.values() for idx in region)
+    if len(idxs) == 0:
+        print('No damage found.')
+        if ignored != 0:
+            print('({} byte(s) differ from the reference in sections passing CRC checks.)'.format(ignored))
+        return
+    print('Damaged regions:')
+    for name, region in sorted(damage.items(), key=lambda item: item[1][0]):
+        print('  {}: {} byte(s) at {}'.format(regionlabel(name)
+        , len(region), rangestring(region)))
+    patterns = damagepatterns(current, idxs)
+    if len(patterns) != 0:
+        print('Patterns:')
+        for pattern in patterns:
+            print('  {}'.format(pattern))
+    if ignored != 0:
+        print('{} byte(s) differ from the reference in sections passing CRC checks (left alone).'.format(ignored))
+    print('')
+    print('{} of {} byte(s) to rewrite:'.format(len(idxs), SPD_DDR5_EEPROM_SIZE))
+    print('--range {}'.format(rangestring(idxs)))
+
+def rangestring(idxs):
+    # Sorted byte offsets as the tightest `--range` argument
+    rngs = []
+    for idx in idxs:
+        if len(rngs) != 0 and rngs[-1][1] == idx - 1:
+            rngs[-1][1] = idx
+        else:
+            rngs.append([idx, idx])
+    return ','.join(str(rng[0]) if rng[0] == rng[1] else '{}-{}'.format(rng[0], rng[1]) for rng in rngs)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
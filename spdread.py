@@ -3,95 +3,166 @@
 import os
 import sys
 import getopt
-from pathlib import Path
+from collections import Counter
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, checkroot, checkddr5, setbackend, SpdDevice, SpdProgress, writespdfile \
+, opttraceformat, settrace, printerr, EEPROM_DUMP_FILE_EXT, SPD_IO_BLOCK_SIZE, SPD_DDR5_EEPROM_SIZE \
+, SPD_DDR5_EEPROM_BLOCK_SIZE, SPD_RSWP_BLOCKS
+from spdinfo import SpdImage
+
+SPD_VOTE_QUORUM = 2
+SPD_VOTE_MAX_READS = 8
 
 def usage():
-    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --help')
+    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --block --vote --quorum <n> --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome> --help')
     sys.exit(1)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'help'])
+        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'block', 'vote', 'quorum=', 'backend=', 'trace=', 'trace-format=', 'help'])
     except getopt.GetoptError:
         usage()
 
     bus = -1
     dimm = -1
+    block = False
+    quorum = 0
+    backend = 'auto'
+    trace = ''
+    tracefmt = 'jsonl'
     for opt, arg in opts:
         try:
             if opt in ('-h', '--help'):
-                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr>')
+                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --block --vote --quorum <n> --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome>')
                 print('  -b --bus: bus number (0)')
                 print('  -d --dimm: dimm address on the bus (0x51)')
+                print('  --block: read in {}-byte I2C blocks instead of byte-by-byte.'.format(SPD_IO_BLOCK_SIZE))
+                print('    (Falls back to byte reads if the adapter does not support block reads.)')
+                print('  --vote: read every {}-byte block until enough reads agree.'.format(SPD_DDR5_EEPROM_BLOCK_SIZE))
+                print('    (A block covered by a passing CRC counts as one agreeing read, blocks')
+                print('    which disagree are read again up to {} times.)'.format(SPD_VOTE_MAX_READS))
+                print('  --quorum: agreeing reads needed with --vote ({})'.format(SPD_VOTE_QUORUM))
+                print('  --backend: SMBus access method (auto)')
+                print('    (`i2cdev` talks to /dev/i2c-N directly, `i2ctools` runs `i2cget`/`i2cset`.)')
+                print('  --trace: record every SMBus transaction to the file.')
+                print('    (A latency summary is printed at the end.)')
+                print('  --trace-format: `jsonl` or `chrome` (chrome://tracing, Perfetto) (jsonl)')
                 sys.exit(0)
             elif opt in ('-b', '--bus'):
                 bus = optint(arg)
             elif opt in ('-d', '--dimm'):
                 dimm = opthex(arg)
+            elif opt in ('--block'):
+                block = True
+            elif opt in ('--vote'):
+                quorum = max(quorum, SPD_VOTE_QUORUM)
+            elif opt in ('--quorum'):
+                quorum = optint(arg)
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
+            elif opt in ('--trace'):
+                trace = arg
+            elif opt in ('--trace-format'):
+                tracefmt = opttraceformat(arg)
         except:
             usage()
     if bus < 0 or bus > 99 \
-    or dimm < 0x50 or dimm > 0x57:
+    or dimm < 0x50 or dimm > 0x57 \
+    or quorum < 0 or quorum > SPD_VOTE_MAX_READS:
         usage()
 
+    setbackend(backend)
     checkroot()
     checkddr5()
-    readspd(bus, dimm)
-
-EEPROM_DUMP_FILE_EXT = 'spd'
+    if trace != '':
+        settrace(trace, tracefmt)
+    readspd(bus, dimm, block, quorum)
 
-def readspd(busnum, dimmaddr):
+def readspd(busnum, dimmaddr, block, quorum=0):
     if not os.access('./', os.W_OK):
         printerr('Current directory is not writable.')
         sys.exit(1)
     filepath = './dimm{}.{}'.format(dimmaddr, EEPROM_DUMP_FILE_EXT)
-    pathfile = Path(filepath)
-    try:
-        spdfile = open(pathfile, 'wb')
-    except:
-        printerr('Could not open file "{}" for writing.'.format(filepath))
-        sys.exit(1)
 
     print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
-    print('Will now read/write from/to device file /dev/i2c-{}, chip address {}, byte-by-byte.\n'
-    .format(busnum, hex(dimmaddr)))
+    print('Will now read/write from/to device file /dev/i2c-{}, chip address {}, {}.\n'
+    .format(busnum, hex(dimmaddr), 'in {}-byte blocks'.format(SPD_IO_BLOCK_SIZE) if block else 'byte-by-byte'))
 
     go = input('Continue? (yes/no): ').lower()
     print('')
     if go in ['yes']:
-        page = 0
-        start = 0
-        end = SPD_DDR5_EEPROM_SIZE
-        ioerr = False
-        for idx in range(start, end):
-            off = idx % SPD_DDR5_EEPROM_PAGE_SIZE
-            addr = SPD_MREG_DATA | off
-            if off == 0:
-                selectpage(busnum, dimmaddr, page)
-                page += 1
-            out = i2cget(busnum, dimmaddr, addr)
-            out = out[2:].decode()       # strip "0x" and convert to string
-            byte = bytes.fromhex(out)[0] # convert hex string to bytes
-            print('Reading from SPD EEPROM: {}/{}, {}.{} [{}]: {}'.format(idx + 1, end, page - 1, hex(addr), hex(idx), hex(byte)))
-            try:
-                spdfile.write(bytes([byte]))
-            except:
-                ioerr = True
-                printerr('I/O error.')
-                break
-        selectpage(busnum, dimmaddr, 0)
-        spdfile.close()
-        if ioerr:
-            sys.exit(1)
+        with SpdDevice(busnum, dimmaddr) as dev:
+            if quorum != 0:
+                spddata, confidence = votespd(dev, block, quorum)
+            else:
+                spddata = dumpspd(dev, block)
+        if quorum != 0:
+            print('')
+            if not reportvote(confidence, quorum):
+                printerr('Some blocks could not be read reliably, the dump has not been saved.')
+                sys.exit(1)
+        # The dump is only written once it is complete
+        writespdfile(filepath, spddata)
         print('')
         print('SPD EEPROM contents from DIMM {} written to: "{}".'.format(hex(dimmaddr), filepath))
     else:
         print('Exiting without performing any operations on SMBus.')
         sys.exit(0)
 
+def dumpspd(dev, block, verbose=True):
+    step = SPD_IO_BLOCK_SIZE if block else 1
+    start = 0
+    end = SPD_DDR5_EEPROM_SIZE
+    spddata = bytearray()
+    progress = SpdProgress('Reading from SPD EEPROM', end - start)
+    for idx in range(start, end, step):
+        spddata += dev.read(idx, step, block)
+        if verbose:
+            progress.update(idx + step - start, 'page {}'.format(dev.page))
+    if verbose:
+        progress.finish()
+    return spddata
+
+def votespd(dev, block, quorum=SPD_VOTE_QUORUM, verbose=True):
+    # Reads the whole EEPROM once, then every block again until
+    # `quorum` reads of it agree. Blocks covered by a section
+    # with a passing CRC already have one more agreeing read.
+    # Returns the dump and [{reads, votes, crc}] for every block.
+    size = SPD_DDR5_EEPROM_BLOCK_SIZE
+    spddata = dumpspd(dev, block, verbose)
+    reads = [[bytes(spddata[blk * size:(blk + 1) * size])] for blk in range(0, SPD_RSWP_BLOCKS)]
+    crcblocks = set()
+    for section in SpdImage(bytes(spddata)).sections:
+        if section.valid():
+            crcblocks.update(range((section.start + size - 1) // size, section.end // size))
+
+    confidence = []
+    for blk in range(0, SPD_RSWP_BLOCKS):
+        while True:
+            best, votes = Counter(reads[blk]).most_common(1)[0]
+            if blk in crcblocks and best == reads[blk][0]:
+                votes += 1
+            if votes >= quorum or len(reads[blk]) == SPD_VOTE_MAX_READS:
+                break
+            if verbose and len(reads[blk]) > 1:
+                print('Reads of block #{} disagree, reading it again'.format(blk))
+            reads[blk].append(bytes(dev.read(blk * size, size, block)))
+        spddata[blk * size:(blk + 1) * size] = best
+        confidence.append({'reads': len(reads[blk]), 'votes': votes, 'crc': blk in crcblocks})
+    return spddata, confidence
+
+def reportvote(confidence, quorum):
+    # Confidence map: reads and agreeing reads (CRC included) per block
+    print('Block     {}'.format(''.join('{: >3}'.format(blk) for blk in range(0, SPD_RSWP_BLOCKS))))
+    print('Reads     {}'.format(''.join('{: >3}'.format(item['reads']) for item in confidence)))
+    print('Agreeing  {}'.format(''.join('{: >3}'.format(item['votes']) for item in confidence)))
+    print('CRC       {}'.format(''.join('{: >3}'.format('+' if item['crc'] else '') for item in confidence)))
+    failed = [blk for blk, item in enumerate(confidence) if item['votes'] < quorum]
+    print('{} read(s) of {} block(s), {} below quorum.'.format(sum(item['reads'] for item in confidence)
+    , len(confidence), len(failed)))
+    return len(failed) == 0
+
 if __name__ == '__main__':
-    if __package__ == None:
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from spdcommon import optint, opthex, checkroot, checkddr5, selectpage, i2cget, printerr \
-    , SPD_MREG_DATA, SPD_DDR5_EEPROM_SIZE, SPD_DDR5_EEPROM_PAGE_SIZE
     main(sys.argv[1:])
@@ -4,33 +4,42 @@ import os
 import sys
 import getopt
 
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, checkroot, checkddr5, setbackend, rswpblocksset, SpdDevice, printerr
+
 def usage():
-    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --first <0..15> --last <0..15> --help')
+    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --first <0..15> --last <0..15> --backend <auto|i2cdev|i2ctools> --help')
     sys.exit(1)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'first=', 'last=', 'help'])
+        opts, args = getopt.getopt(argv, 'b:d:h', ['bus=', 'dimm=', 'first=', 'last=', 'backend=', 'help'])
     except getopt.GetoptError:
         usage()
 
     bus = -1
     dimm = -1
+    backend = 'auto'
     first = -1
     last = -1
     for opt, arg in opts:
         try:
             if opt in ('-h', '--help'):
-                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --first <0..15> --last <0..15>')
+                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --first <0..15> --last <0..15> --backend <auto|i2cdev|i2ctools>')
                 print('  -b --bus: bus number (0)')
                 print('  -d --dimm: dimm address on the bus (0x51)')
                 print('  --first: first block to protect (0)')
                 print('  --last: last block to protect (9)')
+                print('  --backend: SMBus access method (auto)')
+                print('    (`i2cdev` talks to /dev/i2c-N directly, `i2ctools` runs `i2cget`/`i2cset`.)')
                 sys.exit(0)
             elif opt in ('-b', '--bus'):
                 bus = optint(arg)
             elif opt in ('-d', '--dimm'):
                 dimm = opthex(arg)
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
             elif opt in ('--first'):
                 first = optint(arg)
             elif opt in ('--last'):
@@ -43,6 +52,7 @@ def main(argv):
     or last < first or last > 15:
         usage()
 
+    setbackend(backend)
     checkroot()
     checkddr5()
     setrswp(bus, dimm, first, last)
@@ -73,9 +83,16 @@ def setrswp(busnum, dimmaddr, blockfrom, blockto):
         go = input('REALLY continue? (yes/no): ').lower()
         print('')
     if go in ['yes']:
-        for idx in range(blockfrom, blockto + 1):
-            rswpblockset(busnum, dimmaddr, idx)
+        blocks = range(blockfrom, blockto + 1)
+        with SpdDevice(busnum, dimmaddr) as dev:
+            rswpblocks = rswpblocksset(dev, blocks)
         print('')
+        # Registers are read back after writing
+        failed = [block for block in blocks if not rswpblocks[block]]
+        if len(failed) != 0:
+            printerr('RSWP could not be set for block(s) {} on DIMM {}!'.format(', '.join('#{}'.format(block)
+            for block in failed), hex(dimmaddr)))
+            sys.exit(1)
         print('RSWP is now set for blocks #{}..{} on DIMM {}.'.format(blockfrom, blockto, hex(dimmaddr)))
         print('')
         print('This protection can now only be removed using a dedicated hardware DDR5 RAM programmer device.')
@@ -84,22 +101,5 @@ def setrswp(busnum, dimmaddr, blockfrom, blockto):
         print('Exiting without performing any operations on SMBus.')
         sys.exit(0)
 
-def rswpblockset(busnum, dimmaddr, block):
-    mreg = SPD_MREG_RSWP_FIRST + int(block >= 8)
-    blockidx = block % 8
-    out = i2cget(busnum, dimmaddr, mreg)
-    out = out[2:].decode()
-    oldbyte = bytes.fromhex(out)[0]
-    if (oldbyte >> blockidx) & 1 == 0:
-        newbyte = oldbyte | (1 << blockidx)
-        print('Setting RSWP bit for block {0: >3} (register {1}, {2} -> {3})'
-        .format('#' + str(block), hex(mreg), hex(oldbyte), hex(newbyte)))
-        # DANGER: no way back after this!
-        i2cset(busnum, dimmaddr, mreg, newbyte)
-
 if __name__ == '__main__':
-    if __package__ == None:
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from spdcommon import optint, opthex, checkroot, checkddr5, i2cget, i2cset, printerr \
-    , SPD_MREG_RSWP_FIRST
     main(sys.argv[1:])
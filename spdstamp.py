@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import getopt
+from time import monotonic
+from pathlib import Path
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, writespdfile, printerr, EEPROM_DUMP_FILE_EXT
+from spdinfo import SpdImage, SPD_MANUF_DATE_OFFSET, SPD_SN_OFFSET, SPD_SN_LENGTH
+from spdbatch import gettargets
+from spdplan import rangestring
+
+SPD_STAMP_OFFSETS = range(SPD_MANUF_DATE_OFFSET, SPD_SN_OFFSET + SPD_SN_LENGTH)
+
+def usage():
+    printerr(sys.argv[0], '--donor <dump> --serial <sn>[,...] [--count <n>] | --serials <file> --date <week>/<year> --out <dir>'
+    , '--target <bus>:<dimm>[,...] --manifest <file> --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'h', ['donor=', 'serial=', 'count=', 'serials=', 'date=', 'out=', 'target='
+        , 'manifest=', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    donor = ''
+    serials = []
+    count = 0
+    listfile = ''
+    date = None
+    out = '.'
+    tstr = ''
+    manifest = ''
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--donor <dump> --serial <sn>[,...] [--count <n>] | --serials <file> --date <week>/<year> --out <dir>'
+                , '--target <bus>:<dimm>[,...] --manifest <file>')
+                print('  --donor: SPD dump all images are made from (must pass its CRC checks).')
+                print('  --serial: serial number(s) as shown by `spdinfo.py` (0104eef6)')
+                print('  --count: make this many images with consecutive serial numbers.')
+                print('  --serials: read serial numbers from the file, one per line,')
+                print('    optionally followed by the production date (0104eef6 37/2023).')
+                print('  --date: production date of all images (the donor\'s)')
+                print('  --out: directory to save "<partnum>_<serial>.spd" images to (.)')
+                print('  --target: modules the images are meant for, in the same order.')
+                print('  --manifest: write `spdbatch.py --manifest` jobs for the targets.')
+                print('    (Only the bytes differing from the donor are included in the ranges.)')
+                sys.exit(0)
+            elif opt in ('--donor'):
+                donor = arg
+            elif opt in ('--serial'):
+                serials = [(optserial(serial), None) for serial in arg.split(',')]
+            elif opt in ('--serials'):
+                listfile = arg
+            elif opt in ('--count'):
+                count = optint(arg)
+            elif opt in ('--date'):
+                date = optdate(arg)
+            elif opt in ('--out'):
+                out = arg
+            elif opt in ('--target'):
+                tstr = arg
+            elif opt in ('--manifest'):
+                manifest = arg
+        except:
+            usage()
+    if donor == '' \
+    or (len(serials) == 0) == (listfile == '') \
+    or count < 0 or count != 0 and len(serials) != 1 \
+    or (tstr == '') != (manifest == ''):
+        usage()
+    if count != 0:
+        first = int(serials[0][0], 16)
+        serials = [('{:08x}'.format((first + n) & 0xffffffff), None) for n in range(0, count)]
+    if listfile != '':
+        serials = readserials(listfile)
+    targets = []
+    if tstr != '':
+        targets = gettargets(tstr, '', None)
+        if len(targets) == 0:
+            usage()
+        if len(targets) != len(serials):
+            printerr('{} target(s) given for {} serial number(s).'.format(len(targets), len(serials)))
+            sys.exit(1)
+
+    stampspd(donor, serials, date, out, targets, manifest)
+
+def optserial(arg):
+    if len(arg) != SPD_SN_LENGTH * 2:
+        raise ValueError('Serial number must be {} hexadecimal digits'.format(SPD_SN_LENGTH * 2))
+    return bytes.fromhex(arg).hex()
+
+def optdate(arg):
+    # (week, year) from `<week>/<year>`
+    week, year = arg.split('/')
+    week = optint(week)
+    year = optint(year) % 100
+    if week < 1 or week > 53:
+        raise ValueError('Invalid week: {}'.format(week))
+    return week, year
+
+def readserials(filepath):
+    serials = []
+    try:
+        with open(filepath, 'r') as file:
+            lines = file.readlines()
+    except OSError:
+        printerr('Could not read serial numbers from "{}".'.format(filepath))
+        sys.exit(1)
+    for num, line in enumerate(lines, 1):
+        fields = line.split('#')[0].split()
+        if len(fields) == 0:
+            continue
+        try:
+            if len(fields) > 2:
+                raise ValueError('Too many fields')
+            serials.append((optserial(fields[0]), optdate(fields[1]) if len(fields) > 1 else None))
+        except ValueError as e:
+            printerr('"{}", line {}: {}.'.format(filepath, num, e))
+            sys.exit(1)
+    if len(serials) == 0:
+        printerr('No serial numbers in "{}".'.format(filepath))
+        sys.exit(1)
+    return serials
+
+def bcdbyte(value):
+    return (value // 10) << 4 | value % 10
+
+def stampimage(donor, serial, date):
+    # Personalized copy of the donor image, and the offsets
+    # where it differs: identity bytes and CRCs (if affected)
+    image = SpdImage(bytes(donor.view))
+    if date is not None:
+        image.write(SPD_MANUF_DATE_OFFSET, [bcdbyte(date[1]), bcdbyte(date[0])])
+    image.write(SPD_SN_OFFSET, bytes.fromhex(serial))
+    image.fixcrc()
+    offsets = set(SPD_STAMP_OFFSETS)
+    for section in image.sections:
+        offsets.update((section.end - 2, section.end - 1))
+    changed = [idx for idx in sorted(offsets) if image[idx] != donor[idx]]
+    # Same as the donor: an empty range would mean the whole EEPROM
+    return image, changed if len(changed) != 0 else list(SPD_STAMP_OFFSETS)
+
+def stampspd(donorpath, serials, date, out, targets, manifest):
+    donor = SpdImage.fromfile(donorpath)
+    if not donor.isddr5():
+        printerr("SPD dump doesn't appear to be from DDR5 memory.")
+        sys.exit(1)
+    status = donor.crcstatus()
+    if 'fail' in status.values():
+        printerr('Donor fails CRC check(s): {}. Repair it first (see `spdplan.py`).'.format(', '.join(name
+        for name in status if status[name] == 'fail')))
+        sys.exit(1)
+    seen = set()
+    for serial, serialdate in serials:
+        if serial in seen:
+            printerr('Serial number {} is given more than once.'.format(serial))
+            sys.exit(1)
+        seen.add(serial)
+    try:
+        Path(out).mkdir(parents=True, exist_ok=True)
+    except OSError:
+        printerr('Could not create directory "{}".'.format(out))
+        sys.exit(1)
+
+    prefix = ''.join(c if c.isalnum() or c in '.-' else '_' for c in donor.identity['partnumber'].lower())
+    start = monotonic()
+    jobs = []
+    ranges = set()
+    for n, (serial, serialdate) in enumerate(serials):
+        image, changed = stampimage(donor, serial, serialdate or date)
+        filepath = str(Path(out) / '{}_{}.{}'.format(prefix or 'spd', serial, EEPROM_DUMP_FILE_EXT))
+        writespdfile(filepath, image.data)
+        ranges.add(rangestring(changed))
+        if len(targets) != 0:
+            jobs.append({
+                'bus': targets[n][0],
+                'dimm': hex(targets[n][1]),
+                'image': os.path.relpath(filepath, Path(manifest).parent),
+                'range': rangestring(changed),
+                'partnumber': donor.identity['partnumber']
+            })
+    print('{} image(s) written to "{}" in {:.2f} s.'.format(len(serials), out, monotonic() - start))
+    print('Bytes differing from the donor: {}'.format(' or '.join(sorted(ranges))))
+
+    if manifest != '':
+        writespdfile(manifest, ''.join(json.dumps(job) + '\n' for job in jobs).encode())
+        print('')
+        print('Once the modules hold the donor image, flash them with:')
+        print('  sudo ./spdbatch.py --manifest {} --diff'.format(manifest))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
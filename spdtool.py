@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+import os
+import sys
+import shlex
+import getopt
+import importlib
+
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optbackend, setbackend, checkroot, checkddr5, tracefinish, rswpblocksget, SpdDevice, printerr
+
+# Subcommands and the tools implementing them, imported on first use
+SPD_TOOL_COMMANDS = {
+    'read': 'spdread',
+    'write': 'spdwrite',
+    'checkrswp': 'spdcheckrswp',
+    'setrswp': 'spdsetrswp',
+    'batch': 'spdbatch',
+    'plan': 'spdplan',
+    'monitor': 'spdmonitor',
+    'bench': 'spdbench',
+    'index': 'spdindex',
+    'info': 'spdinfo'
+}
+# Subcommands which access SMBus and take `--backend`
+SPD_TOOL_BUS_COMMANDS = ['read', 'write', 'checkrswp', 'setrswp', 'batch', 'plan', 'monitor']
+SPD_TOOL_SEPARATOR = '+'
+
+def usage():
+    printerr(sys.argv[0], '--backend <auto|i2cdev|i2ctools> --shell <command> [<options>] [+ <command> [<options>] ...] --help')
+    sys.exit(1)
+
+def main(argv):
+    try:
+        # Options of the subcommands are left alone
+        opts, args = getopt.getopt(argv, 'h', ['backend=', 'shell', 'help'])
+    except getopt.GetoptError:
+        usage()
+
+    backend = 'auto'
+    shell = False
+    for opt, arg in opts:
+        try:
+            if opt in ('-h', '--help'):
+                print(sys.argv[0], '--backend <auto|i2cdev|i2ctools> --shell <command> [<options>] [+ <command> [<options>] ...]')
+                print('  --backend: SMBus access method for all commands (auto)')
+                print('  --shell: read commands from `stdin`, one per line.')
+                print('  <command>: one of {}'.format(', '.join(SPD_TOOL_COMMANDS)))
+                print('    (Same options as the `spd<command>.py` tool, see `<command> --help`.)')
+                print('')
+                print('Commands separated by `{}` run one after another in the same process,'.format(SPD_TOOL_SEPARATOR))
+                print('sharing SMBus access and DDR5 detection. The first failing command stops the rest.')
+                sys.exit(0)
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
+            elif opt in ('--shell'):
+                shell = True
+        except:
+            usage()
+    if shell == (len(args) != 0):
+        usage()
+
+    setbackend(backend)
+    if shell:
+        status = runshell(backend)
+    else:
+        status = runcommands(splitcommands(args), backend)
+    sys.exit(status)
+
+def splitcommands(args):
+    commands = [[]]
+    for arg in args:
+        if arg == SPD_TOOL_SEPARATOR:
+            commands.append([])
+        else:
+            commands[-1].append(arg)
+    return [command for command in commands if len(command) != 0]
+
+def runcommands(commands, backend='auto'):
+    for command in commands:
+        status = runcommand(command, backend)
+        if status != 0:
+            return status
+    return 0
+
+def runcommand(argv, backend='auto'):
+    # Runs a subcommand in this process, returns its exit status
+    if argv[0] not in SPD_TOOL_COMMANDS:
+        printerr('Unknown command: "{}".'.format(argv[0]))
+        return 1
+    module = importlib.import_module(SPD_TOOL_COMMANDS[argv[0]])
+    args = argv[1:]
+    if argv[0] in SPD_TOOL_BUS_COMMANDS and not any(arg.startswith('--backend') for arg in args):
+        args = args + ['--backend', backend]
+    prog = sys.argv[0]
+    sys.argv[0] = '{} {}'.format(prog, argv[0])
+    try:
+        module.main(args)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    finally:
+        sys.argv[0] = prog
+        # Every command gets its own trace
+        tracefinish()
+    return status
+
+def runshell(backend='auto'):
+    status = 0
+    interactive = sys.stdin.isatty()
+    while True:
+        try:
+            line = input('spdtool> ' if interactive else '')
+        except EOFError:
+            break
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError as e:
+            printerr('Invalid command: {}.'.format(e))
+            status = 1
+            continue
+        if len(argv) == 0:
+            continue
+        if argv[0] in ('exit', 'quit'):
+            break
+        status = runcommand(argv, backend)
+    return status
+
+# The same operations for Python code: nothing is printed or asked
+# for. Errors are reported on `stderr` and raise `SystemExit`, the
+# same way the tools fail.
+
+def session(backend='auto'):
+    # Checks access once, before any of the functions below are used
+    setbackend(backend)
+    checkroot()
+    checkddr5()
+
+def info(image):
+    # `SpdImage` for a dump file, or dump contents
+    from spdinfo import SpdImage
+    if isinstance(image, SpdImage):
+        return image
+    if isinstance(image, (str, os.PathLike)):
+        return SpdImage.fromfile(str(image))
+    return SpdImage(image)
+
+def read(busnum, dimmaddr, block=True):
+    from spdread import dumpspd
+    with SpdDevice(busnum, dimmaddr) as dev:
+        return bytes(dumpspd(dev, block, False))
+
+def write(busnum, dimmaddr, image, rstr='', diff=True, verify=True, retries=None):
+    # Returns the number of bytes written
+    from spdwrite import getranges, flashspd, SPD_VERIFY_RETRIES
+    ranges = getranges(rstr)
+    if len(ranges) == 0:
+        raise ValueError('Invalid ranges: "{}"'.format(rstr))
+    image = info(image)
+    with SpdDevice(busnum, dimmaddr) as dev:
+        return flashspd(dev, image, ranges, diff, verify
+        , SPD_VERIFY_RETRIES if retries is None else retries, False)
+
+def compare(busnum, dimmaddr, image, block=True):
+    # Offsets at which the EEPROM differs from the dump
+    image = info(image)
+    data = read(busnum, dimmaddr, block)
+    return [idx for idx in range(0, len(data)) if data[idx] != image[idx]]
+
+def checkrswp(busnum, dimmaddr):
+    # Write protection of blocks #0..15
+    with SpdDevice(busnum, dimmaddr) as dev:
+        return rswpblocksget(dev)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
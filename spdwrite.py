@@ -2,54 +2,118 @@
 
 import os
 import sys
+import json
 import getopt
+import hashlib
+from time import monotonic
+from pathlib import Path
 from functools import cmp_to_key
 
+if __package__ == None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spdcommon import optint, opthex, optbackend, optwritepoll, optintx, opttraceformat, checkroot, checkddr5, setbackend, setwritepoll, rswpblocksget, settrace, writeestimate, writetimes, writespdfile, SpdDevice, SpdProgress, printerr \
+, SPD_DDR5_EEPROM_SIZE, SPD_DDR5_EEPROM_PAGE_SIZE, SPD_DDR5_EEPROM_BLOCK_SIZE
+from spdinfo import SpdImage, SPD_CRC_SECTIONS, SPD_CRC_SECTION_LABELS
+
+SPD_VERIFY_RETRIES = 2
+SPD_JOURNAL_FILE = '.spdwrite-journal.json'
+SPD_JOURNAL_INTERVAL = 1.0 # seconds between journal updates
+
 def usage():
-    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --file <dump> --range <0-1023>[,0..1023[,...]] --help')
+    printerr(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --file <dump> --range <0-1023>[,0..1023[,...]] --diff --write-poll <status|ack|fixed> --write-timeout <ms> --retries <n> --noverify --resume --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome> --help')
     sys.exit(1)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, 'b:d:f:h', ['bus=', 'dimm=', 'file=', 'range=', 'help'])
+        opts, args = getopt.getopt(argv, 'b:d:f:h', ['bus=', 'dimm=', 'file=', 'range=', 'diff', 'write-poll=', 'write-timeout=', 'retries=', 'noverify', 'resume', 'backend=', 'trace=', 'trace-format=', 'help'])
     except getopt.GetoptError:
         usage()
 
     bus = -1
     dimm = -1
+    backend = 'auto'
     dump = ''
     rstr = ''
+    diff = False
+    poll = 'status'
+    timeout = None
+    verify = True
+    retries = SPD_VERIFY_RETRIES
+    resume = False
+    trace = ''
+    tracefmt = 'jsonl'
     for opt, arg in opts:
         try:
             if opt in ('-h', '--help'):
-                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --file <dump> --range <0-1023>[,0..1023[,...]]')
+                print(sys.argv[0], '--bus <busnum> --dimm <dimmaddr> --file <dump> --range <0-1023>[,0..1023[,...]] --diff --write-poll <status|ack|fixed> --write-timeout <ms> --retries <n> --noverify --resume --backend <auto|i2cdev|i2ctools> --trace <file> --trace-format <jsonl|chrome>')
                 print('  -b --bus: bus number (0)')
                 print('  -d --dimm: dimm address on the bus (0x51)')
                 print('  -f --file: clean SPD dump in raw binary format.')
                 print('  --range: specific region(s) to overwrite.')
                 print('    (Ranges must not overlap.)')
+                print('  --diff: only write bytes that differ from current EEPROM contents.')
+                print('    (Pages touched by the ranges are read first and compared with the dump.)')
+                print('  --write-poll: how to wait for EEPROM write completion (status)')
+                print('    (`status` polls the hub status register, `ack` waits for the hub to respond,')
+                print('    `fixed` always waits for the full timeout as older versions did.)')
+                print('  --write-timeout: upper bound for a single EEPROM write, in milliseconds (100)')
+                print('  --retries: how many times to rewrite bytes which failed verification ({})'.format(SPD_VERIFY_RETRIES))
+                print('  --noverify: do not read back the written pages.')
+                print('    (Otherwise only the pages written to are read back and compared with the dump.)')
+                print('  --resume: continue an interrupted session with the same bus, dimm and dump.')
+                print('    (Ranges are taken from the journal in the current directory.)')
+                print('  --backend: SMBus access method (auto)')
+                print('    (`i2cdev` talks to /dev/i2c-N directly, `i2ctools` runs `i2cget`/`i2cset`.)')
+                print('  --trace: record every SMBus transaction to the file.')
+                print('    (A latency summary is printed at the end.)')
+                print('  --trace-format: `jsonl` or `chrome` (chrome://tracing, Perfetto) (jsonl)')
                 sys.exit(0)
             elif opt in ('-b', '--bus'):
                 bus = optint(arg)
             elif opt in ('-d', '--dimm'):
                 dimm = opthex(arg)
+            elif opt in ('--backend'):
+                backend = optbackend(arg)
             elif opt in ('-f', '--file'):
                 dump = arg
             elif opt in ('--range'):
                 rstr = arg
+            elif opt in ('--diff'):
+                diff = True
+            elif opt in ('--write-poll'):
+                poll = optwritepoll(arg)
+            elif opt in ('--write-timeout'):
+                timeout = optint(arg) / 1000
+            elif opt in ('--retries'):
+                retries = optint(arg)
+            elif opt in ('--noverify'):
+                verify = False
+            elif opt in ('--resume'):
+                resume = True
+            elif opt in ('--trace'):
+                trace = arg
+            elif opt in ('--trace-format'):
+                tracefmt = opttraceformat(arg)
         except:
             usage()
     if bus < 0 or bus > 99 \
     or dimm < 0x50 or dimm > 0x57 \
-    or dump == '':
+    or dump == '' \
+    or timeout is not None and timeout <= 0 \
+    or retries < 0 \
+    or resume and rstr != '':
         usage()
     ranges = getranges(rstr)
     if len(ranges) == 0:
         usage()
 
+    setbackend(backend)
     checkroot()
     checkddr5()
-    writespd(bus, dimm, dump, ranges)
+    setwritepoll(poll, timeout)
+    if trace != '':
+        settrace(trace, tracefmt)
+    writespd(bus, dimm, dump, ranges, diff, verify, retries, resume)
 
 def rangesortfunc(a, b):
     return a[0] - b[0]
@@ -82,18 +146,132 @@ def getranges(rstr):
             return []
     return rngv
 
-def rswpblocksget(busnum, dimmaddr):
-    rswpblocks = []
-    for reg in range(0, 2):
-        out = i2cget(busnum, dimmaddr, SPD_MREG_RSWP_FIRST + reg)
-        out = out[2:].decode()
-        byte = bytes.fromhex(out)[0]
-        for bit in range(0, 8):
-            rswpblocks.append(bool((byte >> bit) & 1))
-    return rswpblocks
+def readpages(dev, pages, data, verbose=True):
+    for page in sorted(pages):
+        if verbose:
+            print('Reading from SPD EEPROM: page {}'.format(page))
+        off = page * SPD_DDR5_EEPROM_PAGE_SIZE
+        data[off:off + SPD_DDR5_EEPROM_PAGE_SIZE] = dev.read(off, SPD_DDR5_EEPROM_PAGE_SIZE)
+
+def readcurrent(dev, ranges, image, verbose=True):
+    # Only the pages touched by the ranges are read back,
+    # the rest is assumed to match the dump
+    current = bytearray(image.data)
+    pages = set()
+    for rng in ranges:
+        pages.update(range(rng[0] // SPD_DDR5_EEPROM_PAGE_SIZE, rng[1] // SPD_DDR5_EEPROM_PAGE_SIZE + 1))
+    readpages(dev, pages, current, verbose)
+    return current
+
+def planwrites(image, ranges, current):
+    # Byte indices to write for each range:
+    # with `current` contents known, only those that differ
+    plan = []
+    for rng in ranges:
+        plan.append([idx for idx in range(rng[0], rng[1] + 1)
+        if current is None or current[idx] != image[idx]])
+    return plan
+
+def reportplan(ranges, plan, rswpblocks):
+    total = 0
+    for rng in ranges:
+        total += rng[1] - rng[0] + 1
+    planned = 0
+    writes = 0
+    switches = 1 # restore of the first virtual page
+    page = -1
+    for idxs in plan:
+        planned += len(idxs)
+        for idx in idxs:
+            if rswpblocks[idx // SPD_DDR5_EEPROM_BLOCK_SIZE]:
+                continue
+            writes += 1
+            if idx // SPD_DDR5_EEPROM_PAGE_SIZE != page:
+                page = idx // SPD_DDR5_EEPROM_PAGE_SIZE
+                switches += 1
+    print('{} byte(s) to write, {} skipped ({} up to date, {} write-protected).'
+    .format(writes, total - writes, total - planned, planned - writes))
+    print('Estimated time: at most {:.1f} seconds.'.format(writeestimate(writes, switches)))
+    print('')
+    return writes
+
+class SpdJournal:
+    # Progress of a flashing session: the highest offset written
+    # (or skipped as write-protected) in every range is saved to
+    # disk, so that an interrupted session can be resumed.
+    def __init__(self, busnum, dimmaddr, image, filepath=SPD_JOURNAL_FILE):
+        self.filepath = filepath
+        self.key = '{}:{}:{}'.format(busnum, hex(dimmaddr), hashlib.sha256(image.data).hexdigest())
+        self.entries = {}
+        self.saved = monotonic()
+        if Path(filepath).exists():
+            try:
+                self.entries = json.loads(Path(filepath).read_text())
+            except (OSError, ValueError):
+                printerr('Could not read journal "{}".'.format(filepath))
+                sys.exit(1)
+        self.entry = self.entries.get(self.key)
+
+    def begin(self, dumpfile, ranges):
+        self.entry = {'file': dumpfile, 'ranges': ranges, 'committed': [rng[0] - 1 for rng in ranges]}
+        self.entries[self.key] = self.entry
+        self.save()
+
+    def commit(self, idx):
+        for num, rng in enumerate(self.entry['ranges']):
+            if rng[0] <= idx <= rng[1]:
+                self.entry['committed'][num] = max(self.entry['committed'][num], idx)
+        if monotonic() - self.saved >= SPD_JOURNAL_INTERVAL:
+            self.save()
+
+    def rollback(self, idx):
+        for num, rng in enumerate(self.entry['ranges']):
+            if rng[0] <= idx <= rng[1]:
+                self.entry['committed'][num] = min(self.entry['committed'][num], idx - 1)
 
-def writespd(busnum, dimmaddr, filepath, ranges):
-    spddata = readspdfile(filepath)
+    def remaining(self):
+        return [[committed + 1, rng[1]] for rng, committed in zip(self.entry['ranges'], self.entry['committed'])
+        if committed < rng[1]]
+
+    def save(self):
+        writespdfile(self.filepath, json.dumps(self.entries).encode())
+        self.saved = monotonic()
+
+    def finish(self):
+        del self.entries[self.key]
+        self.entry = None
+        if len(self.entries) == 0:
+            Path(self.filepath).unlink(missing_ok=True)
+        else:
+            self.save()
+
+def resumecheck(dev, image, journal, verbose=True):
+    # Re-verify the last page written in every range before
+    # continuing: bytes found different are written again
+    rswpblocks = rswpblocksget(dev)
+    readback = bytearray(SPD_DDR5_EEPROM_SIZE)
+    for rng, committed in zip(journal.entry['ranges'], list(journal.entry['committed'])):
+        if committed < rng[0]:
+            continue
+        page = committed // SPD_DDR5_EEPROM_PAGE_SIZE
+        readpages(dev, [page], readback, verbose)
+        for idx in range(max(rng[0], page * SPD_DDR5_EEPROM_PAGE_SIZE), committed + 1):
+            if not rswpblocks[idx // SPD_DDR5_EEPROM_BLOCK_SIZE] and readback[idx] != image[idx]:
+                journal.rollback(idx)
+                break
+
+def writespd(busnum, dimmaddr, filepath, ranges, diff, verify=True, retries=SPD_VERIFY_RETRIES, resume=False):
+    image = SpdImage.fromfile(filepath)
+    journal = SpdJournal(busnum, dimmaddr, image)
+    if resume:
+        if journal.entry is None:
+            printerr('No interrupted session to resume for "{}" on DIMM {}.'.format(filepath, hex(dimmaddr)))
+            sys.exit(1)
+        ranges = journal.entry['ranges']
+        print('Resuming interrupted session: {} of {} byte(s) left.\n'.format(
+        sum(rng[1] - rng[0] + 1 for rng in journal.remaining()), sum(rng[1] - rng[0] + 1 for rng in ranges)))
+    elif journal.entry is not None:
+        print('NOTE: session interrupted earlier is discarded (see `--resume`).\n')
 
     print('WARNING! Improper use of this tool can result in data corruption over SMBus and hardware failure.\n')
     print('Will now read/write from/to device file /dev/i2c-{}, chip address {}, byte-by-byte.\n'
@@ -102,35 +280,110 @@ def writespd(busnum, dimmaddr, filepath, ranges):
     go = input('Continue? (yes/no): ').lower()
     print('')
     if go in ['yes']:
-        page = -1
-        rswpblocks = rswpblocksget(busnum, dimmaddr)
-        for rng in ranges:
-            start = rng[0]
-            end = rng[1] + 1
-            for idx in range(start, end):
-                block = int(idx / SPD_DDR5_EEPROM_BLOCK_SIZE)
-                pagenew = int(idx / SPD_DDR5_EEPROM_PAGE_SIZE)
-                off = idx % SPD_DDR5_EEPROM_PAGE_SIZE
-                addr = SPD_MREG_DATA | off
-                byte = spddata[idx]
-                if rswpblocks[block]:
-                    print('Write-protected: {}/{}, {} -> {}.{} [{}]'.format(idx + 1, end, hex(byte), pagenew, hex(addr), hex(idx)))
-                    continue
-                if pagenew != page:
-                    page = pagenew
-                    selectpage(busnum, dimmaddr, page)
-                print('Writing to SPD EEPROM: {}/{}, {} -> {}.{} [{}]'.format(idx + 1, end, hex(byte), page, hex(addr), hex(idx)))
-                i2cset(busnum, dimmaddr, addr, byte)
-        selectpage(busnum, dimmaddr, 0)
+        if not resume:
+            journal.begin(filepath, ranges)
+        with SpdDevice(busnum, dimmaddr) as dev:
+            if resume:
+                resumecheck(dev, image, journal)
+                print('')
+            flashspd(dev, image, journal.remaining(), diff, verify, retries, True, journal)
+        journal.finish()
         print('')
-        print('Successfully flashed "{}" to DIMM {}.'.format(filepath, hex(dimmaddr)))
+        count, median, maximum = writetimes()
+        if count != 0:
+            print('Write completion: {} write(s), median {:.1f} ms, max {:.1f} ms.'
+            .format(count, median * 1000, maximum * 1000))
+        print('Successfully flashed{} "{}" to DIMM {}.'.format(' and verified' if verify else '', filepath, hex(dimmaddr)))
     else:
         print('Exiting without performing any operations on SMBus.')
         sys.exit(0)
 
+def flashspd(dev, image, ranges, diff, verify=True, retries=SPD_VERIFY_RETRIES, verbose=True, journal=None):
+    rswpblocks = rswpblocksget(dev)
+    current = None
+    if diff:
+        current = readcurrent(dev, ranges, image, verbose)
+        if verbose:
+            print('')
+    plan = planwrites(image, ranges, current)
+    if verbose:
+        progress = SpdProgress('Writing to SPD EEPROM', reportplan(ranges, plan, rswpblocks))
+    written = []
+    try:
+        for rng, idxs in zip(ranges, plan):
+            for idx in idxs:
+                # Write-protected bytes are only counted by `reportplan()`
+                if not rswpblocks[idx // SPD_DDR5_EEPROM_BLOCK_SIZE]:
+                    dev.write(idx, [image[idx]])
+                    written.append(idx)
+                    if verbose:
+                        progress.update(len(written), 'page {}'.format(dev.page))
+                if journal is not None:
+                    journal.commit(idx)
+            if journal is not None:
+                journal.commit(rng[1]) # bytes left out by `--diff`
+    finally:
+        if verbose:
+            progress.finish()
+        # Interrupted or not, keep the journal up to date
+        if journal is not None:
+            journal.save()
+    if verify and len(written) != 0:
+        if verbose:
+            print('')
+        verifyspd(dev, image, written, current, retries, verbose, journal)
+    return len(written)
+
+def verifyspd(dev, image, written, current, retries, verbose=True, journal=None):
+    # Read back only the pages which were written to,
+    # rewriting the bytes that didn't stick
+    readback = bytearray(SPD_DDR5_EEPROM_SIZE)
+    pages = set(idx // SPD_DDR5_EEPROM_PAGE_SIZE for idx in written)
+    pending = written
+    attempt = 0
+    try:
+        while True:
+            readpages(dev, set(idx // SPD_DDR5_EEPROM_PAGE_SIZE for idx in pending), readback, verbose)
+            mismatched = [idx for idx in pending if readback[idx] != image[idx]]
+            if len(mismatched) == 0:
+                break
+            for idx in mismatched:
+                printerr('Verification failed: [{}] {} != {}'.format(hex(idx), hex(readback[idx]), hex(image[idx])))
+            if attempt == retries:
+                printerr('{} byte(s) could not be written!'.format(len(mismatched)))
+                sys.exit(1)
+            attempt += 1
+            if verbose:
+                print('Rewriting {} byte(s), attempt {}/{}'.format(len(mismatched), attempt, retries))
+            for idx in mismatched:
+                dev.write(idx, [image[idx]])
+            pending = mismatched
+    except BaseException:
+        # Failed or interrupted: bytes not known to have stuck
+        # are written (and verified) again by `--resume`
+        if journal is not None:
+            for idx in pending:
+                journal.rollback(idx)
+            journal.save()
+        raise
+
+    # CRCs of the EEPROM contents: pages not read back are
+    # assumed to hold what was read before writing or,
+    # failing that, the dump itself
+    merged = SpdImage(bytes(image.view))
+    for page in range(0, SPD_DDR5_EEPROM_SIZE // SPD_DDR5_EEPROM_PAGE_SIZE):
+        off = page * SPD_DDR5_EEPROM_PAGE_SIZE
+        if page in pages:
+            merged.write(off, readback[off:off + SPD_DDR5_EEPROM_PAGE_SIZE])
+        elif current is not None:
+            merged.write(off, current[off:off + SPD_DDR5_EEPROM_PAGE_SIZE])
+    expected = image.crcstatus()
+    status = merged.crcstatus()
+    for name in SPD_CRC_SECTIONS:
+        if expected[name] == 'pass' and status[name] != 'pass':
+            printerr('WARNING: {} mismatch after writing!'.format(SPD_CRC_SECTION_LABELS[name].strip()))
+    if verbose:
+        print('Verified {} byte(s) on {} page(s).'.format(len(written), len(pages)))
+
 if __name__ == '__main__':
-    if __package__ == None:
-        sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from spdcommon import optint, opthex, optintx, checkroot, checkddr5, readspdfile, selectpage, i2cget, i2cset, printerr \
-    , SPD_MREG_RSWP_FIRST, SPD_MREG_DATA, SPD_DDR5_EEPROM_SIZE, SPD_DDR5_EEPROM_PAGE_SIZE, SPD_DDR5_EEPROM_BLOCK_SIZE
     main(sys.argv[1:])